@@ -1,7 +1,20 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 from datetime import datetime, date, timedelta
+import re
+import os
+import hmac
+import hashlib
 import time
+import queue
+import random
+import threading
+import sqlite3
+import inspect
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor, Future
 import io
 import base64
 import requests
@@ -10,6 +23,10 @@ from email.mime.text import MIMEText
 import gspread
 from google.oauth2.service_account import Credentials
 from gspread.exceptions import APIError
+from gspread.utils import rowcol_to_a1, numericise_all
+from openpyxl import load_workbook
+import xlsxwriter
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 # [新增] Google Calendar API
 from googleapiclient.discovery import build
 
@@ -27,10 +44,1008 @@ SMTP_PORT = 587
 SENDER_EMAIL = ""      
 SENDER_PASSWORD = ""   
 
+# 各資料表欄位 (空表時的預設欄位)
+TABLE_COLUMNS = {
+    "tasks": ['task_id', 'owner_email', 'task_name', 'description', 'start_date', 'end_date', 'size', 'points', 'status', 'progress_pct', 'progress_desc', 'manager_comment', 'created_at', 'approved_at'],
+    "employees": ["email", "name", "password", "department", "manager_email", "role", "line_token"],
+    "departments": ["dept_id", "dept_name", "level", "parent_dept_id"],
+    "system_settings": ["key", "value"],
+    "system_admin": ["account", "password"]
+}
+
+# Excel 匯入任務：中文欄名對照與每批列數 (讀取與 append_rows 皆以此分批)
+TASK_IMPORT_COLUMNS = {"任務名稱": "task_name", "說明": "description", "開始日期": "start_date", "結束日期": "end_date", "大小": "size"}
+TASK_IMPORT_CHUNK = 1000
+
+# 各資料表主鍵
+TABLE_KEYS = {"tasks": "task_id", "employees": "email", "departments": "dept_id", "system_settings": "key", "system_admin": "account"}
+
+# [新增] 各資料表欄位型別，載入時套用一次 (未列出的欄位維持字串)
+# 清單 = 類別欄 (未列出的值自動加入類別)；int16 = 小整數 (空白 / 非數字為 0)；date = 日期 (空白為 NaT)；email = 去空白小寫字串
+TASK_STATUSES = ["Draft", "Submitted", "Approved", "Completed", "Rejected"]
+TABLE_SCHEMA = {
+    "tasks": {"owner_email": "email", "status": TASK_STATUSES, "size": list(POINT_RANGES), "points": "int16", "progress_pct": "int16",
+              "start_date": "date", "end_date": "date", "created_at": "date", "approved_at": "date"},
+    "employees": {"email": "email", "manager_email": "email"},
+}
+
+# 資料表快取存活秒數 (可用 st.secrets["cache_config"]["ttl_seconds"] 覆寫)；逾時後先比對資料版本，有變更才整表重讀
+TABLE_CACHE_TTL = 60
+# 背景寫入佇列：收到第一筆後等待的秒數 (讓同時提交的寫入合併送出) 與單次 append 的最多列數
+WRITE_FLUSH_DELAY = 0.1
+WRITE_BATCH_ROWS = 5000
+
+# 同一段時間內多張表逾時只查詢一次資料版本 (秒；可用 st.secrets["cache_config"]["poll_seconds"] 覆寫)
+VERSION_POLL_SECONDS = 2
+
+# Sheets API 每分鐘配額 (服務帳戶視為單一使用者；可用 st.secrets["quota_config"]["read_per_minute" / "write_per_minute"] 覆寫)
+SHEETS_QUOTA = {"read": 60, "write": 60}
+# 會計入讀取配額的 gspread 方法，其餘視為寫入
+SHEETS_READ_OPS = {"open_by_url", "worksheet", "worksheets", "get_all_records", "get_all_values", "find", "cell",
+                   "row_values", "col_values", "values_get", "values_batch_get", "fetch_sheet_metadata", "get_lastUpdateTime"}
+
 # --- 2. 資料庫核心 ---
+class KPIDBError(Exception):
+    """資料存取失敗 (重試後仍失敗或配額等待逾時)；由畫面顯示錯誤，不再當成空表"""
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+# [新增] 寫入方法的回傳值：照舊拆成 (成功, 訊息)，另附背景寫入的 ticket
+class WriteResult(tuple):
+    """ticket 為寫入佇列的 Future (未排入寫入時為 None)：done() 表示已送達儲存引擎，result() 為 (成功, 訊息)"""
+    def __new__(cls, *values, ticket=None):
+        result = super().__new__(cls, values)
+        result.ticket = ticket
+        return result
+
+def to_cell(v):
+    """轉成可 JSON 序列化的儲存格值 (numpy 數值 -> Python 數值，日期 -> YYYY-MM-DD，空值 -> "")"""
+    if v is None or v is pd.NaT or (isinstance(v, float) and v != v): return ""
+    if isinstance(v, date): return v.strftime("%Y-%m-%d")
+    if hasattr(v, 'item') and not isinstance(v, str): return v.item()
+    return v
+
+def fmt_date(v):
+    """日期欄顯示用 (NaT / 空白 -> "")"""
+    return str(to_cell(v))
+
+def _parse_dates(col):
+    # 先以 YYYY-MM-DD 整欄解析，少數其他格式再逐筆推斷
+    text = col.astype(str).str.strip()
+    out = pd.to_datetime(text, format="%Y-%m-%d", errors="coerce")
+    retry = out.isna() & ~text.isin(["", "nan", "None", "NaT"])
+    if retry.any(): out[retry] = pd.to_datetime(text[retry], format="mixed", errors="coerce")
+    return out
+
+def apply_schema(table_name, df):
+    """依 TABLE_SCHEMA 轉換欄位型別；已是目標型別的欄位不重複轉換"""
+    for c, kind in TABLE_SCHEMA.get(table_name, {}).items():
+        if c not in df.columns: continue
+        col = df[c]
+        if isinstance(kind, list):
+            if isinstance(col.dtype, pd.CategoricalDtype) and list(col.cat.categories[:len(kind)]) == kind: continue
+            text = col.astype(str).str.strip()
+            df[c] = pd.Categorical(text, categories=kind + sorted(set(text.unique()) - set(kind)))
+        elif kind == "int16":
+            if col.dtype != np.int16: df[c] = pd.to_numeric(col, errors="coerce").fillna(0).clip(-32768, 32767).astype(np.int16)
+        elif kind == "date":
+            if not pd.api.types.is_datetime64_any_dtype(col): df[c] = _parse_dates(col)
+        elif kind == "email":
+            df[c] = col.astype(str).str.strip().str.lower()
+    return df
+
+def cast_value(table_name, col, v):
+    """單一儲存格值轉成 TABLE_SCHEMA 型別 (寫入後同步快照用)"""
+    kind = TABLE_SCHEMA.get(table_name, {}).get(col)
+    if kind is None: return v
+    if isinstance(kind, list): return str(v).strip()
+    if kind == "int16":
+        n = pd.to_numeric(v, errors="coerce")
+        return 0 if pd.isna(n) else int(n)
+    if kind == "date": return pd.to_datetime(to_cell(v) or None, errors="coerce")
+    return str(v).strip().lower()
+
+def row_update_ranges(row, values_by_col):
+    """將同一列的 {欄號: 值} 合併成連續區段，供 ws.batch_update 一次送出"""
+    data = []
+    for c in sorted(values_by_col):
+        v = to_cell(values_by_col[c])
+        if data and data[-1]['end'] == c - 1:
+            data[-1]['values'][0].append(v); data[-1]['end'] = c
+        else:
+            data.append({'start': c, 'end': c, 'values': [[v]]})
+    return [{'range': f"{rowcol_to_a1(row, d['start'])}:{rowcol_to_a1(row, d['end'])}", 'values': d['values']} for d in data]
+
+def read_excel_chunks(file, chunk_rows=TASK_IMPORT_CHUNK):
+    """以 openpyxl read_only 模式逐批讀取第一個工作表，產生 (DataFrame, 該批第一列的 Excel 列號)"""
+    wb = load_workbook(file, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = [str(h).strip() if h is not None else "" for h in next(rows, [])]
+        buf, first_row = [], 2
+        for row in rows:
+            buf.append(row[:len(header)])
+            if len(buf) >= chunk_rows:
+                yield pd.DataFrame(buf, columns=header), first_row
+                first_row += len(buf); buf = []
+        if buf: yield pd.DataFrame(buf, columns=header), first_row
+    finally: wb.close()
+
+def validate_task_rows(df, first_row=1):
+    """整欄檢查新增任務 (名稱必填、日期可解析且結束不早於開始、大小為 S/M/L/XL，空白大小視為 M)。
+    回傳 (合法列 DataFrame, 錯誤清單 [{列號, 任務名稱, 錯誤}])；first_row 為第一筆的列號，整列空白者略過"""
+    missing = [c for c in ("task_name", "start_date", "end_date") if c not in df.columns]
+    if missing:
+        labels = {v: k for k, v in TASK_IMPORT_COLUMNS.items()}
+        return df.iloc[0:0], [{"列號": "", "任務名稱": "", "錯誤": "缺少欄位: " + ", ".join(labels.get(c, c) for c in missing)}]
+    df = df.set_axis(range(first_row, first_row + len(df))).replace("", None).dropna(how="all")
+    name = df['task_name'].fillna("").astype(str).str.strip()
+    s = pd.to_datetime(df['start_date'], errors="coerce", format="mixed")
+    e = pd.to_datetime(df['end_date'], errors="coerce", format="mixed")
+    size = (df['size'] if 'size' in df.columns else pd.Series(None, index=df.index)).fillna("").astype(str).str.strip().str.upper().replace("", "M")
+    msgs = pd.Series("", index=df.index)
+    for mask, text in [(name == "", "缺少任務名稱"), (s.isna(), "開始日期格式錯誤"), (e.isna(), "結束日期格式錯誤"),
+                       (e < s, "結束日早於開始日"), (~size.isin(list(POINT_RANGES)), "大小需為 S / M / L / XL")]:
+        msgs = msgs + np.where(mask, text + "；", "")
+    bad = msgs != ""
+    errors = [{"列號": i, "任務名稱": n, "錯誤": m.rstrip("；")} for i, n, m in zip(df.index[bad], name[bad], msgs[bad])]
+    valid = df[~bad].assign(task_name=name[~bad], start_date=s[~bad].dt.strftime("%Y-%m-%d"), end_date=e[~bad].dt.strftime("%Y-%m-%d"), size=size[~bad],
+                            description=df.get('description', pd.Series("", index=df.index))[~bad].fillna("").astype(str))
+    return valid.reset_index(drop=True), errors
+
+class TableCache:
+    """跨 session 共用的資料表快取：以表名為 key，逾 TTL 或被寫入後失效。
+    有 version 函式時，逾 TTL 的快照先比對資料版本 (一次便宜的請求)，未變更就沿用並重新計時"""
+    def __init__(self, ttl=TABLE_CACHE_TTL, version=None, poll=VERSION_POLL_SECONDS):
+        self.ttl = ttl
+        self.version = version
+        self.poll = poll
+        self.lock = threading.Lock()
+        self.version_lock = threading.Lock()
+        self.load_locks = {}
+        self.tables = {}  # table_name -> (載入時間, DataFrame)
+        self.versions = {}  # table_name -> 載入時的資料版本
+        self.derived_objs = {}  # (table_name, key) -> (來源快照, 衍生索引)
+        self.last_version = (0.0, None)  # (查詢時間, 資料版本)
+        self.pins = {}  # table_name -> 尚未送出的寫入數 (期間不重新載入，以免蓋掉樂觀更新)
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+
+    def pin(self, name):
+        with self.lock: self.pins[name] = self.pins.get(name, 0) + 1
+
+    def unpin(self, name):
+        with self.lock:
+            self.pins[name] = self.pins.get(name, 1) - 1
+            if self.pins[name] <= 0: del self.pins[name]
+
+    def pinned(self, name):
+        with self.lock: return self.pins.get(name, 0) > 0
+
+    def current_version(self):
+        """目前的資料版本 (poll 秒內重複使用上次結果)；無法取得時回傳 None，視為已變更"""
+        if self.version is None: return None
+        with self.version_lock:
+            ts, v = self.last_version
+            if time.time() - ts < self.poll: return v
+            try: v = self.version()
+            except Exception: v = None
+            self.last_version = (time.time(), v)
+            return v
+
+    def _load_lock(self, name):
+        with self.lock: return self.load_locks.setdefault(name, threading.RLock())
+
+    def locked(self, name):
+        """寫入期間鎖住該表，避免與同時進行的重新載入交錯"""
+        return self._load_lock(name)
+
+    def get(self, name, loader):
+        # 同一張表同時只讓一個 session 去 Sheets 讀取，其餘等待後直接命中
+        with self._load_lock(name):
+            with self.lock:
+                entry = self.tables.get(name)
+                if entry and (time.time() - entry[0] < self.ttl or self.pins.get(name)):
+                    self.hits += 1
+                    return entry[1]
+            # 逾時：資料版本與載入時相同則沿用快照 (不重讀整表)
+            version = self.current_version()
+            with self.lock:
+                if entry and version is not None and self.versions.get(name) == version and self.tables.get(name) is entry:
+                    self.tables[name] = (time.time(), entry[1])
+                    self.hits += 1; self.revalidated += 1
+                    return entry[1]
+                self.misses += 1
+            df = loader()
+            with self.lock: self.tables[name] = (time.time(), df); self.versions[name] = version
+            return df
+
+    def derived(self, name, key, loader, builder):
+        """取得由快照建立的衍生索引；快照未換新前只建立一次"""
+        df = self.get(name, loader)
+        with self.lock:
+            d = self.derived_objs.get((name, key))
+            if d and d[0] is df: return d[1]
+        obj = builder(df)
+        with self.lock: self.derived_objs[(name, key)] = (df, obj)
+        return obj
+
+    def patch(self, name, fn, derived_updates=None):
+        """將寫入結果套用到快照 (fn 收到副本並回傳新快照)；快照不存在時略過。
+        derived_updates: {衍生索引 key: 更新函式}，與舊快照同步的索引就地更新後沿用，其餘下次使用時重建。
+        複製與更新在全域鎖外進行 (寫入者已由 locked(name) 依表序列化)，只在換上新快照時短暫持鎖"""
+        derived_updates = derived_updates or {}
+        with self.lock:
+            entry = self.tables.get(name)
+            if not entry: return
+            derived = {key: self.derived_objs.get((name, key)) for key in derived_updates}
+        df = fn(entry[1].copy())
+        updated = {(name, key): (df, update(derived[key][1])) for key, update in derived_updates.items()
+                   if derived[key] and derived[key][0] is entry[1]}
+        with self.lock:
+            # 期間快照已被換掉或失效：新快照由儲存引擎重新載入，不覆蓋
+            if self.tables.get(name) is not entry: return
+            self.tables[name] = (entry[0], df)
+            self.derived_objs.update(updated)
+
+    def replace(self, name, df, version=None):
+        """整份換成新快照 (整表覆寫的樂觀更新，或批次預先載入)。
+        version 須在讀取前取得；None 表示未知，逾時即重新載入"""
+        with self.lock:
+            self.tables[name] = (time.time(), df); self.versions[name] = version
+            for k in [k for k in self.derived_objs if k[0] == name]: del self.derived_objs[k]
+
+    def invalidate(self, name=None):
+        with self.lock:
+            if name is None: self.tables.clear(); self.versions.clear(); self.derived_objs.clear()
+            else:
+                self.tables.pop(name, None); self.versions.pop(name, None)
+                for k in [k for k in self.derived_objs if k[0] == name]: del self.derived_objs[k]
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                "ttl": self.ttl, "revalidated": self.revalidated, "version": self.last_version[1],
+                "tables": {k: {"rows": len(v[1]), "age": round(time.time() - v[0], 1), "mb": round(float(v[1].memory_usage(deep=True).sum()) / 2**20, 2)}
+                           for k, v in self.tables.items()}
+            }
+
+class EmployeeDirectory:
+    """員工索引 (每份 employees 快照建立一次)：email -> 資料列 / 主管 / LINE token，主管 -> 直屬部屬"""
+    def __init__(self, df_emp):
+        self.rows = {}
+        self.manager_of = {}
+        self.line_tokens = {}
+        self.reports = {}
+        for r in df_emp.to_dict('records'):
+            email = str(r.get('email', '')).strip().lower()
+            if not email: continue
+            mgr = str(r.get('manager_email', '')).strip().lower()
+            token = str(r.get('line_token', '') or '').strip()
+            self.rows[email] = r
+            self.manager_of[email] = mgr
+            if token: self.line_tokens[email] = token
+            if mgr: self.reports.setdefault(mgr, []).append(email)
+
+    @staticmethod
+    def _key(email): return str(email).strip().lower()
+
+    def get(self, email): return self.rows.get(self._key(email))
+    def name(self, email): return (self.get(email) or {}).get('name', '')
+    def manager(self, email): return self.manager_of.get(self._key(email), '')
+    def token(self, email): return self.line_tokens.get(self._key(email))
+    def direct_reports(self, manager_email): return list(self.reports.get(self._key(manager_email), []))
+    def is_manager(self, email): return self._key(email) in self.reports
+
+    def levels(self, manager_email, depth=None):
+        """逐層列出下屬 [[L1], [L2], ...]，depth=None 表示不限層數 (主管設定成環時每人只出現一次)"""
+        seen = {self._key(manager_email)}
+        frontier, out = [self._key(manager_email)], []
+        while frontier and (depth is None or len(out) < depth):
+            nxt = []
+            for m in frontier:
+                for r in self.reports.get(m, []):
+                    if r not in seen: seen.add(r); nxt.append(r)
+            if nxt: out.append(nxt)
+            frontier = nxt
+        return out
+
+    def subordinates(self, manager_email, depth=None):
+        """depth 層內的所有下屬 (不限層數時即整個組織)"""
+        return [e for level in self.levels(manager_email, depth) for e in level]
+
+    def chain_of_command(self, email):
+        """往上的主管鏈 [直屬主管, 主管的主管, ...]"""
+        chain, seen = [], {self._key(email)}
+        m = self.manager(email)
+        while m and m not in seen:
+            chain.append(m); seen.add(m)
+            m = self.manager_of.get(m, '')
+        return chain
+
+class ApiTelemetry:
+    """外部 API 呼叫紀錄 (Sheets / Calendar / LINE)：逐筆記錄耗時、呼叫端 KPIDB 方法與 session，供配額監控"""
+    COLUMNS = ["ts", "service", "op", "kind", "method", "session", "ms", "ok", "error"]
+
+    def __init__(self, quotas=None, max_events=50000):
+        self.quotas = dict(SHEETS_QUOTA, **(quotas or {}))
+        self.events = deque(maxlen=max_events)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def origin(self):
+        """(最外層的 KPIDB 方法, Streamlit session id)；背景執行緒使用送出時綁定的來源"""
+        bound = getattr(self.local, "origin", None)
+        if bound: return bound
+        method, f = "", inspect.currentframe()
+        while f is not None:
+            if isinstance(f.f_locals.get("self"), KPIDB): method = f.f_code.co_name
+            f = f.f_back
+        ctx = get_script_run_ctx(suppress_warning=True)
+        return method, ctx.session_id if ctx else ""
+
+    @contextmanager
+    def bind(self, origin):
+        prev = getattr(self.local, "origin", None)
+        self.local.origin = origin
+        try: yield
+        finally: self.local.origin = prev
+
+    def record(self, service, op, kind, started, ok=True, error="", origin=None):
+        method, session = origin or self.origin()
+        with self.lock:
+            self.events.append((started, service, op, kind, method, session, round((time.time() - started) * 1000, 1), ok, error))
+
+    @contextmanager
+    def track(self, service, op, kind="read"):
+        """計時一次呼叫；例外照常拋出並記為失敗"""
+        origin, started = self.origin(), time.time()
+        try: yield
+        except Exception as e:
+            self.record(service, op, kind, started, False, f"{type(e).__name__}: {str(e)[:200]}", origin); raise
+        self.record(service, op, kind, started, origin=origin)
+
+    def events_df(self, since=None):
+        with self.lock: rows = list(self.events)
+        df = pd.DataFrame(rows, columns=self.COLUMNS)
+        if since is not None: df = df[df['ts'] >= since]
+        df['ts'] = pd.to_datetime(df['ts'], unit='s', utc=True).dt.tz_convert('Asia/Taipei')
+        return df
+
+    def quota_usage(self, window=60):
+        """近 window 秒的 Sheets 讀 / 寫次數與配額"""
+        since = time.time() - window
+        with self.lock: kinds = [e[3] for e in self.events if e[0] >= since and e[1] == "sheets"]
+        return {k: {"used": kinds.count(k), "quota": self.quotas[k]} for k in ("read", "write")}
+
+    def per_minute(self, minutes=10):
+        """近 N 分鐘每分鐘各服務的呼叫數、錯誤數與平均耗時"""
+        df = self.events_df(since=time.time() - minutes * 60)
+        if df.empty: return pd.DataFrame(columns=["minute", "service", "kind", "calls", "errors", "avg_ms"])
+        df['minute'] = df['ts'].dt.floor('min').dt.strftime('%H:%M')
+        df['failed'] = ~df['ok']
+        return (df.groupby(['minute', 'service', 'kind'])
+                .agg(calls=('op', 'size'), errors=('failed', 'sum'), avg_ms=('ms', 'mean'))
+                .round(1).reset_index().sort_values(['minute', 'service'], ascending=[False, True]))
+
+    def by_method(self, minutes=10):
+        """近 N 分鐘依呼叫端方法 / 操作彙總"""
+        df = self.events_df(since=time.time() - minutes * 60)
+        if df.empty: return pd.DataFrame(columns=["method", "service", "op", "calls", "sessions", "total_ms"])
+        return (df.groupby(['method', 'service', 'op'])
+                .agg(calls=('op', 'size'), sessions=('session', 'nunique'), total_ms=('ms', 'sum'))
+                .round(1).reset_index().sort_values('calls', ascending=False))
+
+    def to_csv(self):
+        return self.events_df().to_csv(index=False, date_format="%Y-%m-%d %H:%M:%S.%f").encode("utf-8-sig")
+
+class RateLimiter:
+    """Sheets 讀 / 寫各一個 token bucket (任意 60 秒內不超過配額)，失敗以抖動指數退避重試，用盡後拋出 KPIDBError。
+    寫入只在 429 (請求未執行) 時重試：5xx / 逾時後寫入可能已生效，重送 append / 刪列會重複新增或多刪"""
+    RETRY_CODES = {429, 500, 502, 503, 504}
+
+    def __init__(self, quotas, burst_ratio=0.25, max_retries=5, backoff=1.0, max_wait=30):
+        self.buckets = {}
+        for kind, quota in quotas.items():
+            burst = max(1, int(quota * burst_ratio))
+            # 突發量 + 60 秒補充量 = 配額
+            self.buckets[kind] = {"capacity": burst, "rate": max(quota - burst, 1) / 60.0, "tokens": float(burst), "ts": time.monotonic()}
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        self.stats = {"throttled": 0, "waited_sec": 0.0, "retries": 0, "failed": 0}
+
+    def _reserve(self, kind):
+        """預扣一個 token，回傳需等待秒數 (可預借成負值，等待者依序排隊而非同時重試)"""
+        with self.lock:
+            b = self.buckets[kind]
+            now = time.monotonic()
+            b["tokens"] = min(b["capacity"], b["tokens"] + (now - b["ts"]) * b["rate"]); b["ts"] = now
+            b["tokens"] -= 1
+            return 0.0 if b["tokens"] >= 0 else -b["tokens"] / b["rate"]
+
+    def acquire(self, kind):
+        if kind not in self.buckets: return
+        wait = self._reserve(kind)
+        if wait <= 0: return
+        if wait > self.max_wait:
+            with self.lock: self.buckets[kind]["tokens"] += 1; self.stats["failed"] += 1
+            raise KPIDBError(f"Google Sheets {kind} 配額已滿，需等待 {wait:.0f} 秒，請稍後再試", 429)
+        with self.lock: self.stats["throttled"] += 1; self.stats["waited_sec"] += wait
+        time.sleep(wait)
+
+    def _drain(self, kind):
+        # 收到 429 時清空 bucket，讓其他 session 也一起放慢
+        with self.lock:
+            if kind in self.buckets: self.buckets[kind]["tokens"] = min(self.buckets[kind]["tokens"], 0.0)
+
+    def call(self, kind, fn):
+        retry_codes = self.RETRY_CODES if kind == "read" else {429}
+        for attempt in range(self.max_retries + 1):
+            self.acquire(kind)
+            retry_after = None
+            try: return fn()
+            except APIError as e:
+                code = getattr(e, "code", None)
+                if code not in retry_codes or attempt == self.max_retries:
+                    with self.lock: self.stats["failed"] += 1
+                    raise KPIDBError(f"Google Sheets API 錯誤 ({code}): {e.error.get('message', e)}", code) from e
+                if code == 429: self._drain(kind)
+                retry_after = e.response.headers.get("Retry-After") if getattr(e, "response", None) is not None else None
+            except requests.RequestException as e:
+                if kind != "read" or attempt == self.max_retries:
+                    with self.lock: self.stats["failed"] += 1
+                    raise KPIDBError(f"Google Sheets 連線失敗: {e}") from e
+            with self.lock: self.stats["retries"] += 1
+            delay = float(retry_after) if retry_after and retry_after.isdigit() else self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+            time.sleep(delay)
+
+class ApiProxy:
+    """包住 gspread 物件，所有方法呼叫都經 RateLimiter 排隊 / 重試並由 ApiTelemetry 計時；回傳的 Spreadsheet / Worksheet 一併包裝"""
+    def __init__(self, target, telemetry, limiter=None, service="sheets"):
+        self._target = target
+        self._telemetry = telemetry
+        self._limiter = limiter
+        self._service = service
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name.startswith("_") or not callable(attr): return attr
+        kind = "read" if name in SHEETS_READ_OPS else "write"
+        def attempt(*args, **kwargs):
+            with self._telemetry.track(self._service, name, kind): return attr(*args, **kwargs)
+        def call(*args, **kwargs):
+            result = self._limiter.call(kind, lambda: attempt(*args, **kwargs)) if self._limiter else attempt(*args, **kwargs)
+            if isinstance(result, list): return [self._wrap(r) for r in result]
+            return self._wrap(result)
+        return call
+
+    def _wrap(self, obj):
+        # Spreadsheet / Worksheet 皆有 id 與 batch_update (Cell、dict 等結果原樣回傳)
+        if hasattr(obj, "batch_update") and hasattr(obj, "id"): return ApiProxy(obj, self._telemetry, self._limiter, self._service)
+        return obj
+
+class CredentialIndex:
+    """登入用帳號索引 (每份 employees / system_admin 快照建立一次)：帳號 -> 密碼雜湊與使用者資料。
+    只保存加鹽雜湊，以 hmac.compare_digest 常數時間比對"""
+    def __init__(self, df, admin=False):
+        self.salt = os.urandom(16)
+        self.entries = {}
+        key_col = "account" if admin else "email"
+        for r in df.to_dict('records'):
+            key = str(r.get(key_col, '')).strip().lower()
+            if not key: continue
+            if admin: user = {"role": "admin", "name": "管理員", "email": "admin"}
+            else: user = {"role": r.get("role") or "user", "name": r.get("name", ""), "email": key, "manager": r.get("manager_email", "")}
+            self.entries[key] = (self._hash(r.get("password", "")), user)
+        self.dummy = self._hash(os.urandom(8).hex())
+
+    def _hash(self, password):
+        return hashlib.sha256(self.salt + str(password).encode("utf-8")).digest()
+
+    def verify(self, account, password):
+        """比對成功回傳使用者資料副本；帳號不存在時仍做一次比對，回應時間不洩漏帳號是否存在"""
+        entry = self.entries.get(str(account).strip().lower())
+        ok = hmac.compare_digest(entry[0] if entry else self.dummy, self._hash(password))
+        return dict(entry[1]) if ok and entry else None
+
+    def set_password(self, account, password):
+        key = str(account).strip().lower()
+        if key in self.entries: self.entries[key] = (self._hash(password), self.entries[key][1])
+        return self
+
+class PointsRollup:
+    """核可點數彙總 (每份 tasks 快照建立一次)：(owner_email, 年月) -> [件數, 點數]。
+    只計入 Approved / Completed 任務，年月取核准日 (未填則取開始日)；寫入時以差量更新，報表只需走訪群組"""
+    STATUSES = ("Approved", "Completed")
+    COLUMNS = ("owner_email", "status", "points", "approved_at", "start_date")
+
+    def __init__(self, df=None, groups=None):
+        self.groups = groups if groups is not None else {}
+        if df is None or df.empty or not set(self.COLUMNS) <= set(df.columns): return
+        done = df[df['status'].isin(self.STATUSES)]
+        # 以整數年月 (YYYYMM) 分組，群組建好後才轉成 "YYYY-MM"
+        when = done['approved_at'].fillna(done['start_date'])
+        ym = (when.dt.year * 100 + when.dt.month).fillna(0).astype(int)
+        agg = done.assign(ym=ym).groupby(['owner_email', 'ym'], sort=False)['points'].agg(['size', 'sum'])
+        self.groups = {(o, f"{m // 100:04d}-{m % 100:02d}" if m else ""): [int(n), int(p)] for (o, m), (n, p) in zip(agg.index, agg.values)}
+
+    @classmethod
+    def _key(cls, row):
+        if not row or str(row.get('status')) not in cls.STATUSES: return None
+        month = str(to_cell(row.get('approved_at')) or to_cell(row.get('start_date')))[:7]
+        return (str(row.get('owner_email', '')).strip().lower(), month)
+
+    def updated(self, changes):
+        """changes: [(舊列, 新列)]，新增列的舊列 / 刪除列的新列為 None。
+        回傳套用差量後的新彙總 (只複製群組，原物件不變，讀取中的畫面不受影響)"""
+        if not changes: return self
+        groups = {k: list(v) for k, v in self.groups.items()}
+        for old, new in changes:
+            for row, sign in ((old, -1), (new, 1)):
+                key = self._key(row)
+                if key is None: continue
+                g = groups.setdefault(key, [0, 0])
+                g[0] += sign; g[1] += sign * cast_value("tasks", "points", row.get('points'))
+                if g[0] <= 0: del groups[key]
+        return PointsRollup(groups=groups)
+
+    def frame(self, emp_dir, owners=None):
+        """彙總表 (部門 / 姓名 / Email / 月份 / 任務數 / 點數)；部門與姓名由員工索引帶入，owners 限定成員"""
+        owners = None if owners is None else {str(o).strip().lower() for o in owners}
+        rows = [((emp_dir.get(o) or {}).get('department') or "(未設定)", emp_dir.name(o) or o, o, m, n, p)
+                for (o, m), (n, p) in self.groups.items() if owners is None or o in owners]
+        return pd.DataFrame(rows, columns=["department", "name", "owner_email", "month", "任務數", "點數"])
+
+class LineDispatcher:
+    """LINE 訊息背景派送：有界佇列 + 工作執行緒 + keep-alive 連線，失敗以指數退避重試。
+    佇列已滿捨棄與重試後仍失敗的訊息記入 telemetry，並經 report(session, 訊息) 回報給送出的 session"""
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+    MULTICAST_LIMIT = 500  # LINE multicast 單次最多 500 位收件人
+
+    def __init__(self, channel_token, api_base="https://api.line.me", workers=2, queue_size=1000, max_retries=4, backoff=0.5, timeout=10, telemetry=None, report=None):
+        self.api_base = api_base.rstrip("/")
+        self.telemetry = telemetry
+        self.report = report
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.session = requests.Session()
+        self.session.headers.update({"Content-Type": "application/json", "Authorization": "Bearer " + channel_token})
+        adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount("https://", adapter); self.session.mount("http://", adapter)
+        self.stats = {"sent": 0, "failed": 0, "dropped": 0, "retries": 0}
+        self.lock = threading.Lock()
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f"line-dispatcher-{i}", daemon=True).start()
+
+    def submit(self, messages):
+        """messages: {收件人 token: 文字}；相同文字的收件人合併為一次 multicast"""
+        by_text = {}
+        for to, text in messages.items():
+            if to and text: by_text.setdefault(text, []).append(to)
+        origin = self.telemetry.origin() if self.telemetry and by_text else None
+        for text, tos in by_text.items():
+            for i in range(0, len(tos), self.MULTICAST_LIMIT):
+                try: self.queue.put_nowait((tos[i:i + self.MULTICAST_LIMIT], text, origin))
+                except queue.Full:
+                    with self.lock: self.stats["dropped"] += 1
+                    self._record("dropped", time.time(), False, "佇列已滿", origin)
+                    self._failed(tos[i:i + self.MULTICAST_LIMIT], text, "佇列已滿，訊息已捨棄", origin)
+
+    def flush(self, timeout=None):
+        """等待佇列清空 (測試 / 關機用)"""
+        end = time.time() + timeout if timeout else None
+        while self.queue.unfinished_tasks:
+            if end and time.time() > end: return False
+            time.sleep(0.05)
+        return True
+
+    def _worker(self):
+        while True:
+            tos, text, origin = self.queue.get()
+            try: ok, error = self._post(tos, text, origin)
+            except Exception as e:
+                ok, error = False, f"{type(e).__name__}: {e}"
+                self._record("error", time.time(), False, error[:200], origin)
+            try:
+                with self.lock: self.stats["sent" if ok else "failed"] += 1
+                if not ok: self._failed(tos, text, error, origin)
+            finally: self.queue.task_done()
+
+    def _record(self, op, started, ok, error, origin):
+        if self.telemetry: self.telemetry.record("line", op, "write", started, ok, error, origin or ("", ""))
+
+    def _failed(self, tos, text, error, origin):
+        if self.report: self.report((origin or ("", ""))[1], f"LINE 通知未送達 ({len(tos)} 位收件人「{text[:20]}」): {error}")
+
+    def _post(self, tos, text, origin=None):
+        op = "push" if len(tos) == 1 else "multicast"
+        if op == "push": url, payload = f"{self.api_base}/v2/bot/message/push", {"to": tos[0]}
+        else: url, payload = f"{self.api_base}/v2/bot/message/multicast", {"to": tos}
+        payload["messages"] = [{"type": "text", "text": text}]
+        for attempt in range(self.max_retries + 1):
+            started = time.time()
+            try:
+                resp = self.session.post(url, json=payload, timeout=self.timeout)
+                self._record(op, started, resp.status_code < 300, "" if resp.status_code < 300 else f"HTTP {resp.status_code}", origin)
+                if resp.status_code < 300: return True, ""
+                error = f"HTTP {resp.status_code} {resp.text[:200]}"
+                if resp.status_code not in self.RETRY_STATUS: return False, error
+                retry_after = resp.headers.get("Retry-After")
+            except requests.RequestException as e:
+                error = f"{type(e).__name__}: {str(e)[:200]}"
+                self._record(op, started, False, error, origin); retry_after = None
+            if attempt == self.max_retries: break
+            with self.lock: self.stats["retries"] += 1
+            delay = float(retry_after) if retry_after and retry_after.isdigit() else self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+            time.sleep(delay)
+        return False, error
+
+class WriteQueue:
+    """KPIDB 寫入的單一背景執行緒：依提交順序送出，連續的同表寫入合併成一次請求
+    (同一列的多次修改合併為一筆、連續新增合併為一次 append)。
+    submit 立即回傳 Future (result() 為 (成功, 訊息))；呼叫端已先樂觀更新快照，
+    寫入失敗時該表快照失效，並取消失敗前已排入、依該快照計算的同表寫入"""
+    def __init__(self, store, cache, telemetry=None, flush_delay=WRITE_FLUSH_DELAY, batch_rows=WRITE_BATCH_ROWS):
+        self.store = store
+        self.cache = cache
+        self.telemetry = telemetry
+        self.flush_delay = flush_delay
+        self.batch_rows = batch_rows
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.cancel_upto = {}  # table -> 此序號 (含) 之前排入的寫入取消
+        self.sessions = {}  # session -> {"pending": 未完成數, "failed": [訊息]}
+        self.stats = {"ops": 0, "requests": 0, "coalesced": 0, "failed": 0, "cancelled": 0}
+        threading.Thread(target=self._worker, name="kpidb-writer", daemon=True).start()
+
+    def submit(self, table, kind, payload):
+        """kind / payload: update ({ref: {欄位: 值}}, raw) / append (rows, snapshot_len) / delete refs / replace DataFrame"""
+        fut = Future()
+        origin = self.telemetry.origin() if self.telemetry else ("", "")
+        self.cache.pin(table)
+        with self.lock:
+            self.seq += 1; self.stats["ops"] += 1
+            self.sessions.setdefault(origin[1], {"pending": 0, "failed": []})["pending"] += 1
+            self.queue.put((self.seq, table, kind, payload, fut, origin))
+        return fut
+
+    def status(self, session):
+        """該 session 尚未送出的寫入數與失敗訊息 (失敗訊息只回傳一次；沒有未完成的寫入時移除該 session 的紀錄)"""
+        with self.lock:
+            s = self.sessions.pop(session, None) or {"pending": 0, "failed": []}
+            if s["pending"]: self.sessions[session] = {"pending": s["pending"], "failed": []}
+            return s
+
+    def _settle(self, session, msg=None):
+        """一筆寫入完成 (呼叫端持有 self.lock)：扣除未完成數並記下失敗訊息；無事可回報的 session 紀錄即移除"""
+        s = self.sessions.get(session)
+        if not s: return
+        s["pending"] -= 1
+        if msg: s["failed"].append(msg)
+        if s["pending"] <= 0 and not s["failed"]: del self.sessions[session]
+
+    def report(self, session, msg):
+        """其他背景工作 (例如行事曆) 的失敗訊息，與寫入失敗一起顯示在該 session 的側欄"""
+        with self.lock: self.sessions.setdefault(session, {"pending": 0, "failed": []})["failed"].append(msg)
+
+    def flush(self, timeout=None):
+        """等待佇列清空 (測試 / 關機用)"""
+        end = time.time() + timeout if timeout else None
+        while self.queue.unfinished_tasks:
+            if end and time.time() > end: return False
+            time.sleep(0.02)
+        return True
+
+    def _worker(self):
+        while True:
+            batch = [self.queue.get()]
+            time.sleep(self.flush_delay)
+            while True:
+                try: batch.append(self.queue.get_nowait())
+                except queue.Empty: break
+            for group in self._groups(batch):
+                try: self._apply(group)
+                except Exception as e: self._crashed(group, e)
+            for _ in batch: self.queue.task_done()
+
+    def _crashed(self, group, error):
+        """寫入佇列本身的非預期錯誤：記入 telemetry，該表快照失效，尚未完成的寫入回報失敗 (顯示在各 session 側欄)"""
+        table, msg = group[0][1], f"寫入佇列錯誤 ({group[0][1]}): {type(error).__name__}: {error}"
+        if self.telemetry: self.telemetry.record("kpidb", "write_queue", "write", time.time(), False, msg[:200], group[0][5])
+        self.cache.invalidate(table)
+        for seq, _, _, _, fut, (method, session) in group:
+            if fut.done(): continue
+            with self.lock: self.stats["failed"] += 1; self._settle(session, msg)
+            self.cache.unpin(table)
+            fut.set_result((False, msg))
+
+    def _groups(self, batch):
+        """相鄰且可合併的寫入分成一組 (刪除的列位置依前一次刪除後的快照計算，不合併)"""
+        groups = []
+        for item in batch:
+            _, table, kind, payload = item[:4]
+            last = groups[-1][0] if groups else None
+            same = last is not None and last[1] == table and last[2] == kind and kind != "delete"
+            if same and kind == "update": same = last[3][1] == payload[1]
+            if same and kind == "append": same = sum(len(i[3][0]) for i in groups[-1]) + len(payload[0]) <= self.batch_rows
+            if same: groups[-1].append(item)
+            else: groups.append([item])
+        return groups
+
+    def _apply(self, group):
+        _, table, kind, payload, _, origin = group[0]
+        with self.lock: cancel = self.cancel_upto.get(table, 0)
+        live = [item for item in group if item[0] > cancel]
+        result = (False, "先前的寫入失敗，此變更已取消，請重新整理後再試")
+        if live:
+            try:
+                with self.telemetry.bind(origin) if self.telemetry else nullcontext():
+                    if kind == "update":
+                        merged = {}
+                        for item in live:
+                            for ref, changes in item[3][0].items(): merged.setdefault(ref, {}).update(changes)
+                        with self.lock: self.stats["coalesced"] += sum(len(i[3][0]) for i in live) - len(merged)
+                        in_place = self.store.update_cells(table, merged, raw=payload[1])
+                    elif kind == "append": in_place = self.store.append_rows(table, [r for item in live for r in item[3][0]], payload[1])
+                    elif kind == "delete": in_place = self.store.delete_rows(table, payload)
+                    elif kind == "replace": self.store.replace_table(table, live[-1][3]); in_place = True
+                # 試算表與快照錯位 (例如被直接編輯)：寫入已依主鍵送到正確的列，快照重新載入
+                if not in_place: self.cache.invalidate(table)
+                with self.lock: self.stats["requests"] += 1
+                result = (True, "已儲存")
+            except Exception as e:
+                result = (False, f"寫入失敗 ({table}): {e}")
+                # 在表鎖內記下取消點並讓快照失效：已排入的同表寫入都依舊快照計算，一併取消
+                with self.cache.locked(table):
+                    with self.lock: self.cancel_upto[table] = self.seq; self.stats["failed"] += 1
+                    self.cache.invalidate(table)
+        for seq, _, _, _, fut, (method, session) in group:
+            ok, msg = result if seq > cancel else (False, "先前的寫入失敗，此變更已取消，請重新整理後再試")
+            with self.lock:
+                if not ok and seq <= cancel: self.stats["cancelled"] += 1
+                self._settle(session, None if ok else msg)
+            self.cache.unpin(table)
+            fut.set_result((ok, msg))
+
+class StorageEngine:
+    """KPIDB 儲存介面。讀取回傳整張表；寫入以 ref = (快照中的位置, 主鍵) 指定資料列"""
+    name = ""
+
+    def read_table(self, table): raise NotImplementedError
+    def data_version(self):
+        """便宜的資料版本 (任何來源的寫入都會改變)；None 表示不支援，快取逾時即整表重讀"""
+        return None
+    def read_tables(self, tables):
+        """一次讀取多張表 {表名: DataFrame}；引擎可覆寫為單一批次請求"""
+        return {t: self.read_table(t) for t in tables}
+    def append_rows(self, table, rows, snapshot_len):
+        """新增列 (依 TABLE_COLUMNS 欄序)，回傳快照是否可直接接在尾端"""
+        raise NotImplementedError
+    def update_cells(self, table, changes, raw=True):
+        """changes: {ref: {欄位: 值}}，一次送出；回傳各列是否仍在快照位置 (False 表示快照需重新載入)"""
+        raise NotImplementedError
+    def delete_rows(self, table, refs):
+        """刪除 refs 指定的列，回傳值同 update_cells"""
+        raise NotImplementedError
+    def replace_table(self, table, df): raise NotImplementedError
+
+class SheetsStorage(StorageEngine):
+    """Google Sheets 引擎 (原有行為)：列位置 = 快照位置 + 標題列"""
+    name = "sheets"
+    HEADER_ROWS = {"system_admin": 0}  # system_admin 以 get_all_values 整表讀入 (含第 1 列)
+    TEXT_TABLES = {"employees", "system_settings"}  # 不把數字字串轉成數值 (例如密碼 "0123")
+    KEY_CHECK_RANGES = 100  # 確認主鍵時單次 values_batch_get 最多的範圍數 (避免請求網址過長)
+
+    def __init__(self, creds, spreadsheet_url, telemetry=None, limiter=None):
+        # [新增] 經 ApiProxy 包裝後，所有 gspread 呼叫皆經限流 / 重試並計入 telemetry
+        self.client = gspread.authorize(creds)
+        if telemetry: self.client = ApiProxy(self.client, telemetry, limiter)
+        self.sh = self.client.open_by_url(spreadsheet_url)
+        # [修改] 一次取得試算表中繼資料 (所有工作表)，不再逐一呼叫 worksheet()
+        sheets = {ws.title: ws for ws in self.sh.worksheets()}
+        missing = [t for t in TABLE_COLUMNS if t not in sheets]
+        if missing: raise gspread.exceptions.WorksheetNotFound(", ".join(missing))
+        self.ws = {t: sheets[t] for t in TABLE_COLUMNS}
+
+    def _row(self, table, pos): return pos + self.HEADER_ROWS.get(table, 1) + 1
+
+    @staticmethod
+    def _spans(rows):
+        """列號合併成連續區段 [[起, 迄], ...] (由小到大)"""
+        spans = []
+        for r in sorted(set(rows)):
+            if spans and spans[-1][1] == r - 1: spans[-1][1] = r
+            else: spans.append([r, r])
+        return spans
+
+    def _resolve(self, table, refs):
+        """寫入前確認每個 ref 的實際列號 (試算表可能被直接編輯而與快照錯位)：
+        只讀 refs 所在列的主鍵儲存格 (連續列合併為一個範圍，一次 values_batch_get)，成本與 ref 數成正比；
+        主鍵不符的 ref 才讀整欄主鍵、依主鍵找列。回傳 ({ref: 列號}, 是否全部在快照位置)；已不存在的主鍵不寫入"""
+        norm = (lambda k: str(k).strip().lower()) if table == "employees" else (lambda k: str(k).strip())
+        spans, found = self._spans(self._row(table, pos) for pos, key in refs), {}
+        for i in range(0, len(spans), self.KEY_CHECK_RANGES):
+            chunk = spans[i:i + self.KEY_CHECK_RANGES]
+            resp = self.sh.values_batch_get([f"'{table}'!A{a}:A{b}" for a, b in chunk])
+            for (a, b), vr in zip(chunk, resp.get('valueRanges', [])):
+                for j, v in enumerate(vr.get('values', [])): found[a + j] = norm(v[0]) if v else ""
+        rows, missed = {}, []
+        for pos, key in refs:
+            if found.get(self._row(table, pos)) == norm(key): rows[(pos, key)] = self._row(table, pos)
+            else: missed.append((pos, key))
+        if missed:
+            header = self.HEADER_ROWS.get(table, 1)
+            index = {norm(k): r for r, k in reversed(list(enumerate(self.ws[table].col_values(1), start=1))) if r > header}
+            for pos, key in missed:
+                if norm(key) in index: rows[(pos, key)] = index[norm(key)]
+        return rows, not missed
+
+    def _frame(self, table, values):
+        """整張表的儲存格值 -> DataFrame (與 get_all_records 相同：首列為欄名、數字字串轉數值，TEXT_TABLES 除外)"""
+        if table == "system_admin":
+            return pd.DataFrame([(list(r) + ["", ""])[:2] for r in values], columns=TABLE_COLUMNS["system_admin"])
+        if not values: return pd.DataFrame()
+        head = values[0]
+        rows = [(list(r) + [""] * len(head))[:len(head)] for r in values[1:]]
+        if table not in self.TEXT_TABLES: rows = [numericise_all(r) for r in rows]
+        df = pd.DataFrame(rows, columns=head)
+        if table == "tasks" and not df.empty and "task_id" not in df.columns:
+            ws = self.ws[table]
+            ws.clear(); ws.append_row(TABLE_COLUMNS["tasks"])
+            return pd.DataFrame(columns=TABLE_COLUMNS["tasks"])
+        return df
+
+    def read_table(self, table):
+        return self._frame(table, self.ws[table].get_all_values())
+
+    def data_version(self):
+        # Drive 檔案最後修改時間：App 與直接在試算表上的編輯都會改變，只需一次中繼資料請求
+        return self.sh.get_lastUpdateTime()
+
+    def read_tables(self, tables):
+        """單一 values_batch_get 讀取多張整表"""
+        resp = self.sh.values_batch_get([f"'{t}'" for t in tables])
+        return {t: self._frame(t, vr.get('values', [])) for t, vr in zip(tables, resp.get('valueRanges', []))}
+
+    def append_rows(self, table, rows, snapshot_len):
+        ws = self.ws[table]
+        # [修改] 不再整表 get_all_values；僅在快照為空時讀第 1 列確認標題
+        if snapshot_len == 0 and self.HEADER_ROWS.get(table, 1) and not ws.row_values(1): ws.append_row(TABLE_COLUMNS[table])
+        resp = ws.append_rows(rows)
+        try: start_row = int(re.search(r"![A-Z]+(\d+)", resp['updates']['updatedRange']).group(1))
+        except Exception: return False
+        return start_row == self._row(table, snapshot_len)
+
+    def update_cells(self, table, changes, raw=True):
+        col_no = {c: i + 1 for i, c in enumerate(TABLE_COLUMNS[table])}
+        rows, in_place = self._resolve(table, changes)
+        data = []
+        for ref, vals in changes.items():
+            if ref in rows: data += row_update_ranges(rows[ref], {col_no[c]: v for c, v in vals.items()})
+        if data: self.ws[table].batch_update(data, value_input_option="RAW" if raw else "USER_ENTERED")
+        return in_place
+
+    def delete_rows(self, table, refs):
+        """連續列合併成區段，由下往上排序後以單一 batchUpdate 送出"""
+        rows, in_place = self._resolve(table, refs)
+        reqs = [{"deleteDimension": {"range": {"sheetId": self.ws[table].id, "dimension": "ROWS", "startIndex": a - 1, "endIndex": b}}}
+                for a, b in reversed(self._spans(rows.values()))]
+        if reqs: self.sh.batch_update({"requests": reqs})
+        return in_place
+
+    def replace_table(self, table, df):
+        ws = self.ws[table]
+        ws.clear()
+        ws.update([df.columns.values.tolist()] + df.values.tolist())
+
+class SQLiteStorage(StorageEngine):
+    """本機 SQLite 引擎：主鍵與常用查詢欄位皆建索引，可離線執行"""
+    name = "sqlite"
+    INT_COLUMNS = {"points", "progress_pct"}
+    INDEXES = {"tasks": [["owner_email"], ["status"], ["owner_email", "status"]], "employees": [["manager_email"]]}
+
+    def __init__(self, path, admin_password=None):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            if path != ":memory:": self.conn.execute("PRAGMA journal_mode=WAL")
+            for t, cols in TABLE_COLUMNS.items():
+                defs = ", ".join(f'"{c}" ' + ("INTEGER DEFAULT 0" if c in self.INT_COLUMNS else "TEXT DEFAULT ''") for c in cols)
+                self.conn.execute(f'CREATE TABLE IF NOT EXISTS "{t}" ({defs}, PRIMARY KEY ("{TABLE_KEYS[t]}"))')
+                for idx_cols in self.INDEXES.get(t, []):
+                    idx_name = f"idx_{t}_" + "_".join(idx_cols)
+                    self.conn.execute(f'CREATE INDEX IF NOT EXISTS "{idx_name}" ON "{t}" ({self._cols(idx_cols)})')
+            if admin_password:
+                self.conn.execute('INSERT OR IGNORE INTO "system_admin" ("account", "password") VALUES (?, ?)', ("admin", str(admin_password)))
+
+    @staticmethod
+    def _cols(cols): return ", ".join(f'"{c}"' for c in cols)
+
+    def _insert_sql(self, table):
+        cols = TABLE_COLUMNS[table]
+        return f'INSERT OR REPLACE INTO "{table}" ({self._cols(cols)}) VALUES ({", ".join("?" * len(cols))})'
+
+    def _query(self, sql, params=()):
+        with self.lock: return pd.read_sql_query(sql, self.conn, params=params)
+
+    def read_table(self, table):
+        return self._query(f'SELECT * FROM "{table}" ORDER BY rowid')
+
+    def data_version(self):
+        # 其他連線 (其他程序) 提交後才會改變；本連線的寫入已直接更新快照
+        with self.lock: return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def select(self, table, filters):
+        where, params = [], []
+        for c, v in filters.items():
+            if isinstance(v, (list, set, tuple)):
+                v = list(v)
+                if not v: return pd.DataFrame(columns=TABLE_COLUMNS[table])
+                where.append(f'"{c}" IN ({", ".join("?" * len(v))})'); params += [str(x) for x in v]
+            else:
+                where.append(f'"{c}" = ?'); params.append(str(v))
+        sql = f'SELECT * FROM "{table}"' + (" WHERE " + " AND ".join(where) if where else "") + " ORDER BY rowid"
+        return self._query(sql, params)
+
+    def _values(self, table, row):
+        return [to_cell(v) if c in self.INT_COLUMNS else str(to_cell(v)) for c, v in zip(TABLE_COLUMNS[table], row)]
+
+    def append_rows(self, table, rows, snapshot_len):
+        with self.lock, self.conn: self.conn.executemany(self._insert_sql(table), [self._values(table, r) for r in rows])
+        return True
+
+    def update_cells(self, table, changes, raw=True):
+        key_col = TABLE_KEYS[table]
+        with self.lock, self.conn:
+            for (pos, key), vals in changes.items():
+                sets = ", ".join(f'"{c}" = ?' for c in vals)
+                params = [to_cell(v) if c in self.INT_COLUMNS else str(to_cell(v)) for c, v in vals.items()]
+                self.conn.execute(f'UPDATE "{table}" SET {sets} WHERE "{key_col}" = ?', params + [str(key)])
+        return True
+
+    def delete_rows(self, table, refs):
+        keys = [str(key) for pos, key in refs]
+        with self.lock, self.conn:
+            self.conn.executemany(f'DELETE FROM "{table}" WHERE "{TABLE_KEYS[table]}" = ?', [(k,) for k in keys])
+        return True
+
+    def replace_table(self, table, df):
+        cols = TABLE_COLUMNS[table]
+        df = df.reindex(columns=cols, fill_value="")
+        with self.lock, self.conn:
+            self.conn.execute(f'DELETE FROM "{table}"')
+            self.conn.executemany(self._insert_sql(table), [self._values(table, r) for r in df.values.tolist()])
+
 class KPIDB:
     def __init__(self):
+        quota_cfg = st.secrets.get("quota_config", {})
+        self.telemetry = ApiTelemetry({k: int(quota_cfg[f"{k}_per_minute"]) for k in SHEETS_QUOTA if f"{k}_per_minute" in quota_cfg})
+        self.limiter = RateLimiter(self.telemetry.quotas, max_wait=float(quota_cfg.get("max_wait_seconds", 30)))
         self.connect()
+        cache_cfg = st.secrets.get("cache_config", {})
+        self.cache = TableCache(ttl=float(cache_cfg.get("ttl_seconds", TABLE_CACHE_TTL)), version=self.store.data_version,
+                                poll=float(cache_cfg.get("poll_seconds", VERSION_POLL_SECONDS)))
+        # [新增] 單一背景寫入執行緒 (依序送出、同列合併)
+        write_cfg = st.secrets.get("write_config", {})
+        self.writer = WriteQueue(self.store, self.cache, self.telemetry, flush_delay=float(write_cfg.get("flush_delay", WRITE_FLUSH_DELAY)),
+                                 batch_rows=int(write_cfg.get("batch_rows", WRITE_BATCH_ROWS)))
+        self.preload()
+        self._calendar = None
+        self._calendar_lock = threading.Lock()
+        self._calendar_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="calendar")
+        line_cfg = st.secrets.get("line_config", {})
+        self.line = LineDispatcher(line_cfg.get("channel_access_token", ""), api_base=line_cfg.get("api_base", "https://api.line.me"),
+                                   workers=int(line_cfg.get("workers", 2)), telemetry=self.telemetry, report=self.writer.report)
 
     def connect(self):
         try:
@@ -40,260 +1055,403 @@ class KPIDB:
                 "https://www.googleapis.com/auth/drive",
                 "https://www.googleapis.com/auth/calendar"
             ]
-            creds_dict = dict(st.secrets["gcp_service_account"])
-            creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
-            
-            # [新增] 保存憑證給行事曆使用
-            self.creds = creds
-            
-            self.client = gspread.authorize(creds)
-            sheet_url = st.secrets["sheet_config"]["spreadsheet_url"]
-            self.sh = self.client.open_by_url(sheet_url)
-            self.ws_emp = self.sh.worksheet("employees")
-            self.ws_dept = self.sh.worksheet("departments")
-            self.ws_tasks = self.sh.worksheet("tasks")
-            self.ws_admin = self.sh.worksheet("system_admin")
-            self.ws_settings = self.sh.worksheet("system_settings")
+            # [新增] 保存憑證給行事曆使用 (SQLite 引擎可不設定)
+            self.creds = None
+            if "gcp_service_account" in st.secrets:
+                creds_dict = dict(st.secrets["gcp_service_account"])
+                self.creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
+
+            # [新增] 儲存引擎：st.secrets["storage"]["engine"] = "sheets" (預設) / "sqlite"
+            storage_cfg = st.secrets.get("storage", {})
+            if storage_cfg.get("engine", "sheets") == "sqlite":
+                self.store = SQLiteStorage(storage_cfg.get("sqlite_path", "kpi.db"), admin_password=storage_cfg.get("admin_password"))
+            else:
+                self.store = SheetsStorage(self.creds, st.secrets["sheet_config"]["spreadsheet_url"], telemetry=self.telemetry, limiter=self.limiter)
         except Exception as e:
             st.error(f"連線失敗: {e}")
             st.stop()
 
-    def get_df(self, table_name):
-        defaults = {
-            "tasks": ['task_id', 'owner_email', 'task_name', 'description', 'start_date', 'end_date', 'size', 'points', 'status', 'progress_pct', 'progress_desc', 'manager_comment', 'created_at', 'approved_at'],
-            "employees": ["email", "name", "password", "department", "manager_email", "role", "line_token"],
-            "departments": ["dept_id", "dept_name", "level", "parent_dept_id"],
-            "system_settings": ["key", "value"]
-        }
-        for i in range(3):
-            try:
-                ws = None
-                if table_name == "employees": ws = self.ws_emp
-                elif table_name == "departments": ws = self.ws_dept
-                elif table_name == "tasks": ws = self.ws_tasks
-                elif table_name == "system_settings": ws = self.ws_settings
-                
-                if ws:
-                    data = ws.get_all_records()
-                    df = pd.DataFrame(data)
-                    
-                    if table_name == "tasks" and not df.empty:
-                        df['owner_email'] = df['owner_email'].astype(str).str.strip().str.lower()
-                        df['task_id'] = df['task_id'].astype(str).str.strip()
-                        df['status'] = df['status'].astype(str).str.strip()
-                    if table_name == "employees" and not df.empty:
-                        df['email'] = df['email'].astype(str).str.strip().str.lower()
-                        df['manager_email'] = df['manager_email'].astype(str).str.strip().str.lower()
-                        if 'line_token' not in df.columns: df['line_token'] = ""
-
-                    if df.empty and table_name in defaults: return pd.DataFrame(columns=defaults[table_name])
-                    if table_name == "tasks" and "task_id" not in df.columns:
-                        ws.clear(); ws.append_row(defaults["tasks"])
-                        return pd.DataFrame(columns=defaults["tasks"])
-                    return df
-            except APIError: time.sleep(1)
-        return pd.DataFrame(columns=defaults.get(table_name, []))
-
-    def batch_update_sheet(self, ws, df, key_col):
+    def preload(self, tables=None):
+        """啟動時一次批次讀入所有資料表並放入快取；失敗時略過，各表於首次使用時再個別讀取"""
+        tables = [t for t in (tables or TABLE_COLUMNS) if t in TABLE_COLUMNS]
+        # 先取資料版本再讀表：讀取期間的編輯會使版本不符，逾時後照常重新載入
+        version = self.cache.current_version()
+        try: frames = self.store.read_tables(tables)
+        except Exception: return False
+        for t, df in frames.items(): self.cache.replace(t, self._normalize(t, df), version)
+        return True
+
+    def get_df(self, table_name, **filters):
+        """讀取資料表 (經由共用快取)，回傳副本供呼叫端自由修改。
+        filters 為欄位等值條件 (list 表示 IN)；SQLite 引擎直接走索引查詢 (該表有寫入尚在佇列時改由快照過濾，才看得到剛送出的變更)，
+        其餘引擎由快照過濾。讀取失敗時拋出 KPIDBError (重試與限流由 RateLimiter 處理)"""
+        if filters and isinstance(self.store, SQLiteStorage) and not self.cache.pinned(table_name):
+            return self._normalize(table_name, self.store.select(table_name, filters))
+        df = self.cache.get(table_name, lambda: self._load_df(table_name))
+        for c, v in filters.items():
+            df = df[df[c].isin(list(v))] if isinstance(v, (list, set, tuple)) else df[df[c] == v]
+        return df.copy()
+
+    def _load_df(self, table_name):
+        if table_name not in TABLE_COLUMNS: return pd.DataFrame()
+        return self._normalize(table_name, self.store.read_table(table_name))
+
+    def _normalize(self, table_name, df):
+        """主鍵去空白並套用 TABLE_SCHEMA 型別 (空表亦同，之後接上的新列維持相同型別)"""
+        df = df.reset_index(drop=True)
+        if table_name == "employees" and not df.empty and 'line_token' not in df.columns: df['line_token'] = ""
+        if not df.empty and TABLE_KEYS[table_name] in df.columns:
+            df[TABLE_KEYS[table_name]] = df[TABLE_KEYS[table_name]].astype(str).str.strip()
+
+        if df.empty and table_name in TABLE_COLUMNS: df = pd.DataFrame(columns=TABLE_COLUMNS[table_name])
+        return apply_schema(table_name, df)
+
+    def cache_stats(self):
+        return self.cache.stats()
+
+    def get_emp_dir(self):
+        """員工索引 (隨 employees 快照共用，不另外讀表)"""
+        return self.cache.derived("employees", "directory", lambda: self._load_df("employees"), EmployeeDirectory)
+
+    def get_points_rollup(self):
+        """核可點數彙總 (隨 tasks 快照共用；寫入時由 _patch_cells / _append / _delete 差量更新)"""
+        return self.cache.derived("tasks", "rollup", lambda: self._load_df("tasks"), PointsRollup)
+
+    def points_summary(self, owners=None):
+        """依 (成員, 月份) 的核可件數與點數；owners 為 None 表示全公司"""
+        return self.get_points_rollup().frame(self.get_emp_dir(), owners)
+
+    @staticmethod
+    def _rollup_updates(table_name, changes):
+        # changes 由快照更新函式填入 (舊列, 新列)，彙總在同一次 patch 中套用差量
+        return {"rollup": lambda r: r.updated(changes)} if table_name == "tasks" else None
+
+    def _write(self, table_name, kind, payload):
+        """寫入交給背景佇列 (依序送出、同列合併)，回傳 Future；呼叫端負責樂觀更新快照"""
+        return self.writer.submit(table_name, kind, payload)
+
+    def write_status(self):
+        """目前 session 尚未送出的寫入數與失敗訊息"""
+        ctx = get_script_run_ctx(suppress_warning=True)
+        return self.writer.status(ctx.session_id if ctx else "")
+
+    def batch_update_sheet(self, table_name, df, key_col):
         try:
-            ws.clear()
-            ws.update([df.columns.values.tolist()] + df.values.tolist())
-            return True, "更新成功"
-        except Exception as e: return False, str(e)
+            with self.cache.locked(table_name):
+                # [修改] 整表覆寫排入寫入佇列 (與其他寫入依序執行，不再與 append 交錯)，快照直接換成新表
+                ticket = self._write(table_name, "replace", df)
+                self.cache.replace(table_name, self._normalize(table_name, df.copy()))
+            return WriteResult(True, "更新成功", ticket=ticket)
+        except Exception as e:
+            self.cache.invalidate(table_name); return False, str(e)
+
+    @staticmethod
+    def _settings_dict(df):
+        return dict(zip(df['key'].astype(str), df['value'])) if 'key' in df.columns and 'value' in df.columns else {}
+
+    def get_settings(self):
+        """所有設定 {key: value}：整表讀取一次並隨快照快取，update_setting 後失效"""
+        return self.cache.derived("system_settings", "values", lambda: self._load_df("system_settings"), self._settings_dict)
 
     def get_setting(self, key):
-        try:
-            cell = self.ws_settings.find(key, in_column=1)
-            if cell: return self.ws_settings.cell(cell.row, 2).value
-            return None
-        except: return None
+        return self.get_settings().get(key)
+
+    @staticmethod
+    def _decode_logo(value):
+        """網址原樣使用；base64 / data URI 解碼成 bytes (交給 st.image 以內容雜湊的媒體網址提供，瀏覽器可快取)"""
+        value = str(value or "").strip()
+        if not value: return None
+        if value.startswith("http"): return {"src": value, "hash": hashlib.sha256(value.encode()).hexdigest()[:16]}
+        data = base64.b64decode(value.split(",", 1)[1] if value.startswith("data:") else value)
+        return {"src": data, "hash": hashlib.sha256(data).hexdigest()[:16]}
+
+    def get_logo(self):
+        """Logo 每份設定快照只解碼一次；未設定或格式錯誤時回傳 None"""
+        def build(df):
+            try: return self._decode_logo(self._settings_dict(df).get("logo"))
+            except Exception: return None
+        return self.cache.derived("system_settings", "logo", lambda: self._load_df("system_settings"), build)
 
     def update_setting(self, key, value):
         try:
-            try: cell = self.ws_settings.find(key, in_column=1)
-            except: time.sleep(1); cell = self.ws_settings.find(key, in_column=1)
-            
-            if cell: self.ws_settings.update_cell(cell.row, 2, value)
-            else: self.ws_settings.append_row([key, value])
-            return True, "設定已更新"
-        except Exception as e: return False, str(e)
+            with self.cache.locked("system_settings"):
+                ticket = (self._update_row("system_settings", key, {"value": value}) or
+                          self._append("system_settings", pd.DataFrame([[key, value]], columns=TABLE_COLUMNS["system_settings"])))
+            return WriteResult(True, "設定已更新", ticket=ticket)
+        except Exception as e:
+            self.cache.invalidate("system_settings"); return False, str(e)
+
+    # --- 列定位與快照同步 ---
+    def _snapshot(self, table_name):
+        return self.cache.get(table_name, lambda: self._load_df(table_name))
+
+    def _positions(self, table_name):
+        """主鍵 -> 快照中的位置 (由快照建立；Sheets 引擎再換算成列號)"""
+        key_col = TABLE_KEYS[table_name]
+        return self.cache.derived(table_name, "positions", lambda: self._load_df(table_name),
+                                  lambda df: dict(zip(df[key_col], range(len(df)))) if key_col in df.columns else {})
+
+    def _locate(self, table_name, key):
+        key = str(key).strip()
+        if table_name == "employees": key = key.lower()
+        pos = self._positions(table_name).get(key)
+        if pos is None and not self.cache.pinned(table_name):
+            # 快照中沒有 (可能是其他程序新增)，重新載入一次再查 (有寫入未送出時不重載，以免蓋掉樂觀更新)
+            self.cache.invalidate(table_name)
+            pos = self._positions(table_name).get(key)
+        return pos
+
+    def _update_row(self, table_name, key, changes, raw=False, derived_updates=None):
+        """單列多欄一次寫入 (一個 API 請求，全部成功或全部失敗)，並同步快照；回傳寫入 ticket，找不到該列時回傳 None"""
+        pos = self._locate(table_name, key)
+        if pos is None: return None
+        ticket = self._write(table_name, "update", ({(pos, key): changes}, raw))
+        self._patch_cells(table_name, {pos: changes}, derived_updates)
+        return ticket
+
+    def _patch_cells(self, table_name, changes_by_pos, derived_updates=None):
+        rollup_changes = []
+        def fn(df):
+            for pos, changes in changes_by_pos.items():
+                if table_name == "tasks" and any(c in PointsRollup.COLUMNS for c in changes):
+                    old = {c: df.at[pos, c] for c in PointsRollup.COLUMNS if c in df.columns}
+                    rollup_changes.append((old, {**old, **{c: cast_value(table_name, c, v) for c, v in changes.items() if c in old}}))
+                for c, v in changes.items():
+                    v = cast_value(table_name, c, v)
+                    # 類別欄遇到新值時先加入類別，避免整欄退回 object
+                    if isinstance(df[c].dtype, pd.CategoricalDtype) and v not in df[c].cat.categories: df[c] = df[c].cat.add_categories([v])
+                    try: df.at[pos, c] = v
+                    except (TypeError, ValueError):
+                        df[c] = df[c].astype(object); df.at[pos, c] = v
+            return df
+        derived_updates = {**(self._rollup_updates(table_name, rollup_changes) or {}), **(derived_updates or {})}
+        # 未改到主鍵時列位置不變，位置索引直接沿用
+        if not any(TABLE_KEYS[table_name] in changes for changes in changes_by_pos.values()):
+            derived_updates.setdefault("positions", lambda positions: positions)
+        self.cache.patch(table_name, fn, derived_updates)
+
+    def _task_owner(self, task_id):
+        pos = self._locate("tasks", task_id)
+        return self._snapshot("tasks").at[pos, 'owner_email'] if pos is not None else ""
 
     # --- Google Calendar ---
+    CALENDAR_BATCH_LIMIT = 50  # 單一 batch 請求最多事件數
+
+    def _calendar_service(self):
+        """Calendar 服務只建立一次 (discovery 文件不重複解析)"""
+        with self._calendar_lock:
+            if self._calendar is None:
+                with self.telemetry.track("calendar", "build"):
+                    self._calendar = build('calendar', 'v3', credentials=self.creds, cache_discovery=False)
+            return self._calendar
+
+    @staticmethod
+    def _calendar_event(title, desc, start_str, end_str):
+        # 處理全天事件 (結束日需+1天)
+        e_date_obj = datetime.strptime(str(end_str), "%Y-%m-%d").date()
+        end_date_plus_one = (e_date_obj + timedelta(days=1)).strftime("%Y-%m-%d")
+        return {
+            'summary': f"【KPI】{title}",
+            'description': desc,
+            'start': {'date': str(start_str), 'timeZone': 'Asia/Taipei'},
+            'end': {'date': end_date_plus_one, 'timeZone': 'Asia/Taipei'},
+            'reminders': {
+                'useDefault': False,
+                'overrides': [
+                    {'method': 'popup', 'minutes': 2 * 24 * 60}, # 2天前
+                    {'method': 'email', 'minutes': 24 * 60},     # 1天前
+                ],
+            },
+        }
+
+    def add_events_to_calendar(self, items):
+        """批次寫入行事曆。items: [(owner_email, title, desc, start, end)]，回傳逐筆 [(成功, 訊息)]"""
+        if self.creds is None: return [(False, "未設定 Google 憑證")] * len(items)
+        results = [None] * len(items)
+        pending = []
+        for i, (owner_email, title, desc, start_str, end_str) in enumerate(items):
+            try: pending.append((i, owner_email, self._calendar_event(title, desc, start_str, end_str)))
+            except Exception: results[i] = (False, "日期格式錯誤")
+        if pending:
+            try:
+                service = self._calendar_service()
+
+                def on_done(request_id, response, exception):
+                    if exception is None: results[int(request_id)] = (True, "行事曆寫入成功")
+                    else: results[int(request_id)] = (False, f"行事曆失敗 (請確認該員工已共用日曆給機器人): {exception}")
+
+                for k in range(0, len(pending), self.CALENDAR_BATCH_LIMIT):
+                    batch = service.new_batch_http_request(callback=on_done)
+                    for i, owner_email, event in pending[k:k + self.CALENDAR_BATCH_LIMIT]:
+                        batch.add(service.events().insert(calendarId=owner_email, body=event), request_id=str(i))
+                    with self._calendar_lock, self.telemetry.track("calendar", "events.insert (batch)", "write"): batch.execute()
+            except Exception as e:
+                for i, *_ in pending:
+                    if results[i] is None: results[i] = (False, f"行事曆失敗 (請確認該員工已共用日曆給機器人): {str(e)}")
+        return results
+
+    def add_events_to_calendar_async(self, items):
+        """在背景執行緒送出批次，回傳 Future (result() 為逐筆結果)"""
+        origin = self.telemetry.origin()
+        def job():
+            with self.telemetry.bind(origin): return self.add_events_to_calendar(items)
+        return self._calendar_pool.submit(job)
+
     def add_to_calendar(self, owner_email, title, desc, start_str, end_str):
         """將任務加入使用者的 Google 行事曆"""
-        try:
-            # 建立 Calendar 服務
-            service = build('calendar', 'v3', credentials=self.creds)
-            
-            # 處理全天事件 (結束日需+1天)
-            try:
-                e_date_obj = datetime.strptime(end_str, "%Y-%m-%d").date()
-                end_date_plus_one = (e_date_obj + timedelta(days=1)).strftime("%Y-%m-%d")
-            except: return False, "日期格式錯誤"
-
-            event = {
-                'summary': f"【KPI】{title}",
-                'description': desc,
-                'start': {'date': start_str, 'timeZone': 'Asia/Taipei'},
-                'end': {'date': end_date_plus_one, 'timeZone': 'Asia/Taipei'},
-                'reminders': {
-                    'useDefault': False,
-                    'overrides': [
-                        {'method': 'popup', 'minutes': 2 * 24 * 60}, # 2天前
-                        {'method': 'email', 'minutes': 24 * 60},     # 1天前
-                    ],
-                },
-            }
-            # 寫入
-            service.events().insert(calendarId=owner_email, body=event).execute()
-            return True, "行事曆寫入成功"
-        except Exception as e:
-            return False, f"行事曆失敗 (請確認該員工已共用日曆給機器人): {str(e)}"
+        return self.add_events_to_calendar([(owner_email, title, desc, start_str, end_str)])[0]
 
     # --- LINE 通知 ---
     def get_user_token(self, email):
-        try:
-            df = self.get_df("employees")
-            user = df[df['email'] == email]
-            if not user.empty:
-                token = str(user.iloc[0].get('line_token', '')).strip()
-                return token if token else None
-        except: pass
-        return None
+        return self.get_emp_dir().token(email)
 
     def send_line_notify(self, token, message):
+        """交由背景派送，不阻塞畫面"""
         if not token: return
-        try:
-            line_token = st.secrets["line_config"]["channel_access_token"]
-            url = "https://api.line.me/v2/bot/message/push"
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": "Bearer " + line_token
-            }
-            payload = {
-                "to": token, 
-                "messages": [{"type": "text", "text": message}]
-            }
-            requests.post(url, headers=headers, json=payload)
-        except Exception as e:
-            print(f"LINE 發送失敗: {e}")
-        
+        self.line.submit({token: message})
+
     def update_line_token(self, email, token):
         try:
-            cell = self.ws_emp.find(email, in_column=1)
-            if cell:
-                self.ws_emp.update_cell(cell.row, 7, token)
-                return True, "LINE 設定已更新"
+            with self.cache.locked("employees"):
+                ticket = self._update_row("employees", email, {"line_token": token})
+                if ticket: return WriteResult(True, "LINE 設定已更新", ticket=ticket)
             return False, "找不到使用者"
-        except Exception as e: return False, str(e)
+        except Exception as e:
+            self.cache.invalidate("employees"); return False, str(e)
+
+    def _new_task_rows(self, valid, initial_status, base_id, offset=0):
+        """由驗證過的任務列補齊系統欄位，依 TABLE_COLUMNS 欄序回傳"""
+        df = valid.copy()
+        df['task_id'] = [f"{base_id}_{offset + i}_{int(time.time()*1000)%1000}" for i in range(len(df))]
+        df['points'] = 0
+        df['status'] = initial_status
+        df['progress_pct'] = 0
+        df['progress_desc'] = ""
+        df['manager_comment'] = ""
+        df['created_at'] = str(date.today())
+        df['approved_at'] = ""
+        df['owner_email'] = df['owner_email'].astype(str).str.strip().str.lower()
+        for c in TABLE_COLUMNS["tasks"]:
+            if c not in df.columns: df[c] = ""
+        return df[TABLE_COLUMNS["tasks"]]
+
+    def _notify_submitted(self, owner_email, count):
+        emp_dir = self.get_emp_dir()
+        if emp_dir.get(owner_email):
+            mgr_token = emp_dir.token(emp_dir.manager(owner_email))
+            user_name = emp_dir.name(owner_email)
+            if mgr_token:
+                msg = f"【KPI 待審核】\n同仁：{user_name}\n提交了 {count} 筆新任務，請進入系統審核。"
+                self.send_line_notify(mgr_token, msg)
 
     def batch_add_tasks(self, df_tasks, initial_status="Draft"):
         try:
-            for idx, row in df_tasks.iterrows():
-                try:
-                    s_date = pd.to_datetime(row['start_date'])
-                    e_date = pd.to_datetime(row['end_date'])
-                    if e_date < s_date: return False, f"錯誤: 任務 '{row['task_name']}' 結束日早於開始日"
-                except: return False, f"錯誤: 任務 '{row['task_name']}' 日期格式錯誤"
+            valid, errors = validate_task_rows(df_tasks)
+            if errors:
+                return False, "錯誤: " + "；".join(f"第 {e['列號']} 列 {e['任務名稱']} {e['錯誤']}" for e in errors[:10]) + (f" (共 {len(errors)} 筆)" if len(errors) > 10 else "")
+            if valid.empty: return False, "沒有可新增的任務"
+            df_new = self._new_task_rows(valid, initial_status, int(time.time()))
+            ticket = self._append("tasks", df_new)
+            if initial_status == "Submitted": self._notify_submitted(df_new['owner_email'].iloc[0], len(df_new))
+            return WriteResult(True, f"已新增 {len(df_new)} 筆任務", ticket=ticket)
+        except Exception as e:
+            self.cache.invalidate("tasks"); return False, str(e)
 
-            base_id = int(time.time())
-            df_tasks['task_id'] = [f"{base_id}_{i}_{int(time.time()*1000)%1000}" for i in range(len(df_tasks))]
-            
-            df_tasks['points'] = 0
-            df_tasks['status'] = initial_status
-            df_tasks['progress_pct'] = 0
-            df_tasks['progress_desc'] = ""
-            df_tasks['manager_comment'] = ""
-            df_tasks['created_at'] = str(date.today())
-            df_tasks['approved_at'] = ""
-            df_tasks['owner_email'] = df_tasks['owner_email'].astype(str).str.strip().str.lower()
-            df_tasks['start_date'] = df_tasks['start_date'].astype(str)
-            df_tasks['end_date'] = df_tasks['end_date'].astype(str)
-
-            cols = ['task_id', 'owner_email', 'task_name', 'description', 'start_date', 'end_date', 'size', 'points', 'status', 'progress_pct', 'progress_desc', 'manager_comment', 'created_at', 'approved_at']
-            for c in cols:
-                if c not in df_tasks.columns: df_tasks[c] = ""
-            
-            current_vals = self.ws_tasks.get_all_values()
-            if not current_vals: self.ws_tasks.append_row(cols)
-            values = df_tasks[cols].values.tolist()
-            self.ws_tasks.append_rows(values)
-
-            if initial_status == "Submitted":
-                df_emp = self.get_df("employees")
-                owner_email = df_tasks['owner_email'].iloc[0]
-                user_row = df_emp[df_emp['email'] == owner_email]
-                if not user_row.empty:
-                    mgr_email = user_row.iloc[0]['manager_email']
-                    mgr_token = self.get_user_token(mgr_email)
-                    user_name = user_row.iloc[0]['name']
-                    if mgr_token:
-                        msg = f"【KPI 待審核】\n同仁：{user_name}\n提交了 {len(df_tasks)} 筆新任務，請進入系統審核。"
-                        self.send_line_notify(mgr_token, msg)
-
-            return True, f"已新增 {len(values)} 筆任務"
-        except Exception as e: return False, str(e)
+    def import_tasks_excel(self, file, owner_email, initial_status="Draft", chunk_rows=TASK_IMPORT_CHUNK):
+        """串流匯入 Excel 任務：逐批讀取、整欄驗證，合法列逐批 append_rows。
+        回傳 (成功, 訊息, 錯誤明細 DataFrame)；有錯誤的列不匯入，其餘照常新增"""
+        errors, added, base_id, ticket = [], 0, int(time.time()), None
+        try:
+            for chunk, first_row in read_excel_chunks(file, chunk_rows):
+                valid, errs = validate_task_rows(chunk.rename(columns=TASK_IMPORT_COLUMNS), first_row)
+                errors += errs
+                if errs and errs[0]['列號'] == "": break  # 缺少必要欄位，整份不匯入
+                if valid.empty: continue
+                valid['owner_email'] = owner_email
+                ticket = self._append("tasks", self._new_task_rows(valid, initial_status, base_id, added))
+                added += len(valid)
+        except Exception as e:
+            self.cache.invalidate("tasks")
+            return WriteResult(False, f"匯入中斷 (已新增 {added} 筆): {e}", pd.DataFrame(errors, columns=["列號", "任務名稱", "錯誤"]), ticket=ticket)
+        if added and initial_status == "Submitted": self._notify_submitted(str(owner_email).strip().lower(), added)
+        msg = f"已新增 {added} 筆任務" + (f"，{len(errors)} 筆有錯誤未匯入" if errors else "")
+        return WriteResult(added > 0, msg, pd.DataFrame(errors, columns=["列號", "任務名稱", "錯誤"]), ticket=ticket)
+
+    def _append(self, table_name, df_new):
+        """新增列並接到快照尾端 (回傳寫入 ticket)；若引擎回報列號與快照不符，由寫入佇列讓整表失效"""
+        with self.cache.locked(table_name):
+            snap = self._snapshot(table_name)
+            ticket = self._write(table_name, "append", (df_new.values.tolist(), len(snap)))
+            df_new = self._normalize(table_name, df_new.copy())
+            added = [(None, r) for r in df_new.to_dict('records')] if table_name == "tasks" else []
+            self.cache.patch(table_name, lambda df: apply_schema(table_name, pd.concat([df, df_new], ignore_index=True)) if not df.empty else df_new,
+                             self._rollup_updates(table_name, added))
+        return ticket
 
     def delete_batch_tasks_by_ids(self, task_ids):
         try:
-            current = self.ws_tasks.get_all_records()
-            str_ids = [str(t).strip() for t in task_ids]
-            new_records = [r for r in current if str(r['task_id']).strip() not in str_ids]
-            headers = ['task_id', 'owner_email', 'task_name', 'description', 'start_date', 'end_date', 'size', 'points', 'status', 'progress_pct', 'progress_desc', 'manager_comment', 'created_at', 'approved_at']
-            final_data = []
-            for item in new_records:
-                row = [item.get(h, "") for h in headers]
-                final_data.append(row)
-            self.ws_tasks.clear()
-            self.ws_tasks.append_row(headers)
-            self.ws_tasks.append_rows(final_data)
-            return True, "處理成功"
-        except Exception as e: return False, str(e)
+            str_ids = {str(t).strip() for t in task_ids}
+            with self.cache.locked("tasks"):
+                positions = self._positions("tasks")
+                if not str_ids <= positions.keys() and not self.cache.pinned("tasks"):
+                    self.cache.invalidate("tasks"); positions = self._positions("tasks")
+                ticket = self._delete("tasks", [(positions[t], t) for t in str_ids if t in positions])
+            return WriteResult(True, "處理成功", ticket=ticket)
+        except Exception as e:
+            self.cache.invalidate("tasks"); return False, str(e)
+
+    def _delete(self, table_name, refs):
+        """一次刪除多列 (引擎負責合併連續列)，並自快照移除；回傳寫入 ticket"""
+        if not refs: return None
+        ticket = self._write(table_name, "delete", refs)
+        drop = [pos for pos, key in refs]
+        removed = []
+        def fn(df):
+            if table_name == "tasks": removed.extend((r, None) for r in df.loc[drop].to_dict('records'))
+            return df.drop(index=drop).reset_index(drop=True)
+        self.cache.patch(table_name, fn, self._rollup_updates(table_name, removed))
+        return ticket
 
     # --- [修正] 批次更新狀態 (加入行事曆邏輯) ---
     def batch_update_tasks_status(self, updates_list):
         try:
-            all_tasks = self.get_df("tasks")
-            all_tasks['task_id'] = all_tasks['task_id'].astype(str).str.strip()
-            task_map = {str(r['task_id']): i for i, r in all_tasks.iterrows()}
-            count = 0
+            emp_dir = self.get_emp_dir()
             notify_targets = {} 
-            calendar_msgs = [] # 收集行事曆錯誤訊息
-
-            for up in updates_list:
-                tid = str(up['task_id']).strip()
-                if tid in task_map:
-                    idx = task_map[tid]
-                    old_status = all_tasks.at[idx, 'status']
+            calendar_items = [] # 核准任務一次批次寫入行事曆
+            cell_changes = {}  # 只送出有變動的儲存格
+            count, ticket = 0, None
+
+            with self.cache.locked("tasks"):
+                all_tasks = self._snapshot("tasks")
+                positions = self._positions("tasks")
+                for up in updates_list:
+                    tid = str(up['task_id']).strip()
+                    if tid not in positions: continue
+                    pos = positions[tid]
+                    cur = all_tasks.iloc[pos]
+                    old_status = cur['status']
                     new_status = up['status']
-                    
-                    all_tasks.at[idx, 'status'] = new_status
-                    if 'points' in up: all_tasks.at[idx, 'points'] = up['points']
-                    if 'size' in up: all_tasks.at[idx, 'size'] = up['size']
-                    if 'comment' in up: all_tasks.at[idx, 'manager_comment'] = up['comment']
-                    if new_status == "Approved": all_tasks.at[idx, 'approved_at'] = str(date.today())
+
+                    new_vals = {'status': new_status}
+                    if 'points' in up: new_vals['points'] = up['points']
+                    if 'size' in up: new_vals['size'] = up['size']
+                    if 'comment' in up: new_vals['manager_comment'] = up['comment']
+                    if new_status == "Approved": new_vals['approved_at'] = str(date.today())
+                    changes = {c: v for c, v in new_vals.items() if str(to_cell(cur[c])) != str(to_cell(v))}
+                    if changes: cell_changes[(pos, tid)] = changes
                     count += 1
 
-                    owner_email = all_tasks.at[idx, 'owner_email']
-                    task_name = all_tasks.at[idx, 'task_name']
+                    owner_email = cur['owner_email']
+                    task_name = cur['task_name']
                     
                     # [新增] 核准時加入行事曆
                     if new_status == "Approved":
-                        cal_ok, cal_msg = self.add_to_calendar(
-                            owner_email, 
-                            task_name, 
-                            all_tasks.at[idx, 'description'], 
-                            all_tasks.at[idx, 'start_date'], 
-                            all_tasks.at[idx, 'end_date']
-                        )
-                        if not cal_ok: calendar_msgs.append(f"{owner_email}: {cal_msg}")
+                        calendar_items.append((owner_email, task_name, cur['description'], fmt_date(cur['start_date']), fmt_date(cur['end_date'])))
 
                     # LINE 通知邏輯
                     if old_status == "Draft" and new_status == "Submitted":
-                        df_emp = self.get_df("employees")
-                        u_row = df_emp[df_emp['email'] == owner_email]
-                        if not u_row.empty:
-                            mgr_email = u_row.iloc[0]['manager_email']
+                        if emp_dir.get(owner_email):
+                            mgr_email = emp_dir.manager(owner_email)
                             if mgr_email not in notify_targets: notify_targets[mgr_email] = []
                             notify_targets[mgr_email].append(f"同仁送審：{task_name}")
 
@@ -302,91 +1460,90 @@ class KPIDB:
                         st_txt = "✅ 已核准" if new_status == "Approved" else "⚠️ 被退回"
                         notify_targets[owner_email].append(f"任務 {st_txt}：{task_name}")
 
-            if count > 0:
-                for email, msgs in notify_targets.items():
-                    token = self.get_user_token(email)
-                    if token: self.send_line_notify(token, "【KPI 通知】\n" + "\n".join(msgs))
-
-                # 顯示行事曆結果
-                if calendar_msgs:
-                    st.warning("⚠️ 部分行事曆寫入失敗(可能是權限未開)：\n" + "\n".join(calendar_msgs))
-
-                return self.batch_update_sheet(self.ws_tasks, all_tasks, "task_id")
-            return True, "無變更"
-        except Exception as e: return False, str(e)
+                if count == 0: return True, "無變更"
+                # 行事曆批次在背景送出，與試算表寫入同時進行
+                calendar_job = self.add_events_to_calendar_async(calendar_items) if calendar_items and self.creds else None
+                if cell_changes:
+                    # 一次批次寫入，資料量與變動筆數成正比
+                    ticket = self._write("tasks", "update", (cell_changes, True))
+                    self._patch_cells("tasks", {pos: changes for (pos, tid), changes in cell_changes.items()})
+
+            line_msgs = {emp_dir.token(email): "【KPI 通知】\n" + "\n".join(msgs) for email, msgs in notify_targets.items()}
+            self.line.submit({t: m for t, m in line_msgs.items() if t})
+
+            # [修改] 不等待行事曆結果，完成後失敗訊息經寫入狀態回報到該 session 的側欄
+            if calendar_job:
+                session = self.telemetry.origin()[1]
+                def report(job):
+                    try: failed = [f"{owner_email}: {cal_msg}" for (owner_email, *_), (cal_ok, cal_msg) in zip(calendar_items, job.result()) if not cal_ok]
+                    except Exception as e: failed = [str(e)]
+                    if failed: self.writer.report(session, "部分行事曆寫入失敗(可能是權限未開)：\n" + "\n".join(failed))
+                calendar_job.add_done_callback(report)
+            return WriteResult(True, "更新成功", ticket=ticket)
+        except Exception as e:
+            self.cache.invalidate("tasks"); return False, str(e)
 
     def update_task_content(self, task_id, name, desc, s_date, e_date, size, status="Submitted"):
         try:
-            cell = self.ws_tasks.find(str(task_id).strip(), in_column=1)
-            if cell:
-                r = cell.row
-                self.ws_tasks.update_cell(r, 3, name)
-                self.ws_tasks.update_cell(r, 4, desc)
-                self.ws_tasks.update_cell(r, 5, str(s_date))
-                self.ws_tasks.update_cell(r, 6, str(e_date))
-                self.ws_tasks.update_cell(r, 7, size)
-                self.ws_tasks.update_cell(r, 9, status)
-                self.ws_tasks.update_cell(r, 12, "") 
-                
-                if status == "Submitted":
-                    row_vals = self.ws_tasks.row_values(r)
-                    owner = row_vals[1]
-                    df_emp = self.get_df("employees")
-                    u_row = df_emp[df_emp['email'] == owner]
-                    if not u_row.empty:
-                        mgr_token = self.get_user_token(u_row.iloc[0]['manager_email'])
-                        self.send_line_notify(mgr_token, f"【KPI】同仁 {u_row.iloc[0]['name']} 重送任務：{name}")
-
-                return True, "成功"
-            return False, "失敗"
-        except Exception as e: return False, str(e)
+            with self.cache.locked("tasks"):
+                changes = {'task_name': name, 'description': desc, 'start_date': str(s_date), 'end_date': str(e_date),
+                           'size': size, 'status': status, 'manager_comment': ""}
+                ticket = self._update_row("tasks", task_id, changes)
+                if not ticket: return False, "失敗"
+                owner = self._task_owner(task_id)
+
+            if status == "Submitted":
+                emp_dir = self.get_emp_dir()
+                if emp_dir.get(owner):
+                    mgr_token = emp_dir.token(emp_dir.manager(owner))
+                    self.send_line_notify(mgr_token, f"【KPI】同仁 {emp_dir.name(owner)} 重送任務：{name}")
+
+            return WriteResult(True, "成功", ticket=ticket)
+        except Exception as e:
+            self.cache.invalidate("tasks"); return False, str(e)
 
     def delete_task(self, task_id):
         try:
-            cell = self.ws_tasks.find(str(task_id).strip(), in_column=1)
-            if cell: self.ws_tasks.delete_rows(cell.row); return True, "成功"
+            with self.cache.locked("tasks"):
+                pos = self._locate("tasks", task_id)
+                if pos is not None:
+                    ticket = self._delete("tasks", [(pos, str(task_id).strip())])
+                    return WriteResult(True, "成功", ticket=ticket)
             return False, "失敗"
-        except Exception as e: return False, str(e)
+        except Exception as e:
+            self.cache.invalidate("tasks"); return False, str(e)
 
     def update_progress(self, tid, pct, desc):
         try:
-            cell = self.ws_tasks.find(str(tid).strip(), in_column=1)
-            if cell:
-                self.ws_tasks.update_cell(cell.row, 10, pct)
-                self.ws_tasks.update_cell(cell.row, 11, desc)
-                return True, "成功"
+            with self.cache.locked("tasks"):
+                ticket = self._update_row("tasks", tid, {'progress_pct': pct, 'progress_desc': desc})
+                if ticket: return WriteResult(True, "成功", ticket=ticket)
             return False, "失敗"
-        except: return False, "Error"
+        except:
+            self.cache.invalidate("tasks"); return False, "Error"
 
     def change_password(self, email, new_password, role="user"):
         try:
-            if role == "admin":
-                cell = self.ws_admin.find("admin", in_column=1)
-                if cell: self.ws_admin.update_cell(cell.row, 2, new_password)
-            else:
-                cell = self.ws_emp.find(email, in_column=1)
-                if cell: self.ws_emp.update_cell(cell.row, 3, new_password)
-            return True, "密碼已修改"
-        except Exception as e: return False, str(e)
+            table_name, key = ("system_admin", "admin") if role == "admin" else ("employees", email)
+            with self.cache.locked(table_name):
+                # 登入索引就地更新，不必整份重建
+                ticket = self._update_row(table_name, key, {"password": new_password},
+                                          derived_updates={"credentials": lambda idx: idx.set_password(key, new_password)})
+            return WriteResult(True, "密碼已修改", ticket=ticket)
+        except Exception as e:
+            self.cache.invalidate(table_name); return False, str(e)
 
     def verify_user(self, email, password):
         email = str(email).strip().lower()
+        # [修改] 由記憶體中的帳號索引比對 (整表讀取一次，快照更新時重建)；讀取失敗時拋出 KPIDBError
         if email == "admin":
-            try:
-                c = self.ws_admin.find("admin")
-                if c and str(self.ws_admin.cell(c.row, 2).value) == password:
-                    return {"role": "admin", "name": "管理員", "email": "admin"}
-            except: pass
-        try:
-            c = self.ws_emp.find(email, in_column=1)
-            if c:
-                row = self.ws_emp.row_values(c.row)
-                if len(row) > 2 and str(row[2]) == str(password):
-                    role_val = row[5] if len(row) > 5 else "user"
-                    manager_val = row[4] if len(row) > 4 else ""
-                    return {"role": role_val, "name": row[1], "email": str(row[0]).strip().lower(), "manager": manager_val}
-        except: pass
-        return None
+            user = self._credentials("system_admin").verify("admin", password)
+            if user: return user
+        return self._credentials("employees").verify(email, password)
+
+    def _credentials(self, table_name):
+        return self.cache.derived(table_name, "credentials", lambda: self._load_df(table_name),
+                                  lambda df: CredentialIndex(df, admin=table_name == "system_admin"))
 
     def upsert_employee(self, email, name, password, dept, manager, role="user"):
         df = pd.DataFrame([{"email": email, "name": name, "password": password, "department": dept, "manager_email": manager, "role": role}])
@@ -399,7 +1556,7 @@ class KPIDB:
         df_new = df_new[cols].astype(str)
         df_new['email'] = df_new['email'].str.strip().str.lower()
         df_new['manager_email'] = df_new['manager_email'].str.strip().str.lower()
-        return self.batch_update_sheet(self.ws_emp, df_new, "email")
+        return self.batch_update_sheet("employees", df_new, "email")
 
     def batch_import_employees(self, df):
         try:
@@ -416,7 +1573,7 @@ class KPIDB:
         for c in cols: 
             if c not in df_new.columns: df_new[c] = ""
         df_new = df_new[cols].astype(str)
-        return self.batch_update_sheet(self.ws_dept, df_new, "dept_id")
+        return self.batch_update_sheet("departments", df_new, "dept_id")
 
     def batch_import_depts(self, df):
         try:
@@ -437,24 +1594,72 @@ def get_db(): return KPIDB()
 try: sys = get_db()
 except Exception as e: st.error(f"System Error: {e}"); st.stop()
 
-def calc_expected_progress(start_str, end_str):
-    try:
-        s = datetime.strptime(str(start_str), "%Y-%m-%d").date()
-        e = datetime.strptime(str(end_str), "%Y-%m-%d").date()
-        today = date.today()
-        if today < s: return 0
-        if today > e: return 100
-        total = (e - s).days
-        if total <= 0: return 100
-        return int(((today - s).days / total) * 100)
-    except: return 0
-
-def get_full_team_emails(manager_email, df_emp):
-    l1 = df_emp[df_emp['manager_email'] == manager_email]['email'].tolist()
-    l2 = df_emp[df_emp['manager_email'].isin(l1)]['email'].tolist()
-    return list(set(l1 + l2))
+def calc_expected_progress(start, end, progress, today=None):
+    """整欄計算預計進度：start / end 為日期 (或日期字串) Series，回傳 (預計%, 進度差異 = progress - 預計%)。
+    開始前 0、結束後 100、期間為 0 天 100；日期格式錯誤視為 0"""
+    def to_days(col):
+        if pd.api.types.is_datetime64_any_dtype(col): return np.asarray(col, dtype="datetime64[ns]")
+        return pd.to_datetime(pd.Series(np.asarray(col, dtype=object)).astype(str), format="%Y-%m-%d", errors="coerce").to_numpy()
+    s, e = to_days(start), to_days(end)
+    today = np.datetime64(today or date.today(), 'ns')
+    total = (e - s) / np.timedelta64(1, 'D')
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = np.trunc(((today - s) / np.timedelta64(1, 'D') / total) * 100)
+    exp = np.select([np.isnat(s) | np.isnat(e), today < s, today > e, total <= 0], [0, 0, 100, 100], default=ratio).astype(int)
+    exp = pd.Series(exp, index=progress.index)
+    return exp, progress - exp
+
+# 團隊報表欄位 (欄名, 表頭)
+TEAM_REPORT_COLUMNS = [("department", "部門"), ("name", "姓名"), ("owner_email", "Email"), ("task_name", "任務名稱"), ("start_date", "開始"),
+                       ("end_date", "結束"), ("size", "大小"), ("points", "點數"), ("status", "狀態"), ("progress_pct", "回報%"),
+                       ("預計%", "預計%"), ("進度差異", "進度差異"), ("progress_desc", "進度說明"), ("manager_comment", "主管評語")]
+
+def write_team_report(team_df):
+    """以 xlsxwriter constant_memory 模式逐列寫出團隊報表 (任務明細含每人小計 + 人員彙總)，回傳 xlsx bytes。
+    team_df 需含 name / department / 預計% / 進度差異；依部門、姓名、Email 排序後單次走訪 (同名者各自小計)，不為各部門複製 DataFrame"""
+    keys = [k for k, _ in TEAM_REPORT_COLUMNS]
+    df = team_df.reindex(columns=keys).sort_values(['department', 'name', 'owner_email', 'start_date'], kind='stable')
+    pts_col = keys.index('points')
+    out = io.BytesIO()
+    wb = xlsxwriter.Workbook(out, {'constant_memory': True})
+    head = wb.add_format({'bold': True, 'bg_color': '#DDEBF7', 'border': 1})
+    sub = wb.add_format({'bold': True, 'bg_color': '#F2F2F2'})
+    late = wb.add_format({'font_color': 'red'})
+
+    ws = wb.add_worksheet("任務明細")
+    ws.write_row(0, 0, [label for _, label in TEAM_REPORT_COLUMNS], head)
+    ws.freeze_panes(1, 0); ws.set_column(0, 2, 16); ws.set_column(3, 3, 30)
+    summary, r, cur, cnt, pts = [], 1, None, 0, 0
+    for row in df.itertuples(index=False, name=None):
+        row = [to_cell(v) for v in row]
+        if cur is not None and tuple(row[:3]) != cur:
+            ws.write_row(r, 0, list(cur) + [f"小計 {cnt} 筆", "", "", "", pts], sub); r += 1
+            summary.append(list(cur) + [cnt, pts]); cnt = pts = 0
+        cur = tuple(row[:3])
+        ws.write_row(r, 0, row, late if isinstance(row[11], (int, float)) and row[11] < -20 else None); r += 1
+        cnt += 1; pts += row[pts_col] if isinstance(row[pts_col], (int, float)) else 0
+    if cur is not None:
+        ws.write_row(r, 0, list(cur) + [f"小計 {cnt} 筆", "", "", "", pts], sub); r += 1
+        summary.append(list(cur) + [cnt, pts])
+    ws.write_row(r, 0, ["合計", "", "", f"{sum(x[3] for x in summary)} 筆", "", "", "", sum(x[4] for x in summary)], head)
+
+    ws2 = wb.add_worksheet("人員彙總")
+    ws2.write_row(0, 0, ["部門", "姓名", "Email", "任務數", "總點數"], head)
+    ws2.set_column(0, 2, 16)
+    for i, row in enumerate(summary, start=1): ws2.write_row(i, 0, row)
+    wb.close()
+    return out.getvalue()
 
 # --- UI Components ---
+# 日期欄只顯示日期 (不含時間)
+DATE_COLUMN_CONFIG = {"start_date": st.column_config.DateColumn(), "end_date": st.column_config.DateColumn()}
+
+# [新增] 記下寫入 ticket，側欄據此顯示最近一次變更是否已寫入儲存引擎
+def track_write(result):
+    ticket = getattr(result, "ticket", None)
+    if ticket is not None: st.session_state.write_ticket = ticket
+    return result
+
 def change_password_ui(role, email):
     # [修改] 標題增加日曆，並新增 tab3
     with st.expander("🔑 帳號設定 (密碼 / LINE / Google日曆)"):
@@ -465,7 +1670,7 @@ def change_password_ui(role, email):
             cfm_p = st.text_input("確認新密碼", type="password", key="cfm_p")
             if st.button("確認修改"):
                 if new_p == cfm_p and new_p:
-                    succ, msg = sys.change_password(email, new_p, role)
+                    succ, msg = track_write(sys.change_password(email, new_p, role))
                     if succ: st.success(msg)
                     else: st.error(msg)
                 else: st.error("密碼不一致或為空")
@@ -525,13 +1730,11 @@ def render_personal_task_module(user):
 
     with t1:
         st.subheader("我的任務清單")
-        df_tasks = sys.get_df("tasks")
-        if df_tasks.empty:
+        my_email = str(user['email']).strip().lower()
+        my_tasks = sys.get_df("tasks", owner_email=my_email)
+        if my_tasks.empty:
             st.info("尚無任何任務")
         else:
-            df_tasks['owner_email'] = df_tasks['owner_email'].astype(str).str.strip().str.lower()
-            my_email = str(user['email']).strip().lower()
-            my_tasks = df_tasks[df_tasks['owner_email'] == my_email].copy()
             
             drafts = my_tasks[my_tasks['status'] == 'Draft']
             submitted = my_tasks[my_tasks['status'] == 'Submitted']
@@ -540,7 +1743,7 @@ def render_personal_task_module(user):
 
             st.markdown("### 💾 暫存任務")
             if not drafts.empty:
-                st.dataframe(drafts[['task_name', 'start_date', 'end_date', 'size', 'description']], hide_index=True)
+                st.dataframe(drafts[['task_name', 'start_date', 'end_date', 'size', 'description']], column_config=DATE_COLUMN_CONFIG, hide_index=True)
                 draft_opts = [f"{r['task_name']} ({r['task_id']})" for i, r in drafts.iterrows()]
                 selected_drafts = st.multiselect("勾選任務進行操作", draft_opts)
                 
@@ -551,7 +1754,7 @@ def render_personal_task_module(user):
                         tid = item.split("(")[-1].replace(")", "")
                         updates.append({'task_id': tid, 'status': "Submitted"})
                     if updates:
-                        sys.batch_update_tasks_status(updates)
+                        track_write(sys.batch_update_tasks_status(updates))
                         st.success("已送出審核"); time.sleep(1); st.rerun()
                 
                 if c2.button("✏️ 帶入批次編輯 (並刪除原暫存)"):
@@ -572,68 +1775,82 @@ def render_personal_task_module(user):
                         while len(load_data) < 10: load_data.append({"task_name": "", "description": "", "start_date": date.today(), "end_date": date.today()+timedelta(days=7), "size": "M"})
                         st.session_state.batch_df = pd.DataFrame(load_data)
                         st.session_state.editor_key += 1
-                        sys.delete_batch_tasks_by_ids(ids_to_del)
+                        track_write(sys.delete_batch_tasks_by_ids(ids_to_del))
                         st.success("已載入並刪除舊資料，請切換至「批次新增任務」頁籤"); time.sleep(2); st.rerun()
                 if c3.button("🗑️ 刪除 (選取項目)"):
                     ids = [item.split("(")[-1].replace(")", "") for item in selected_drafts]
-                    sys.delete_batch_tasks_by_ids(ids)
+                    track_write(sys.delete_batch_tasks_by_ids(ids))
                     st.success("已刪除"); time.sleep(1); st.rerun()
             else: st.caption("無暫存任務")
             
             st.divider(); st.markdown("### ⏳ 送審中")
-            if not submitted.empty: st.dataframe(submitted[['task_name', 'start_date', 'end_date', 'size', 'description']], hide_index=True)
+            if not submitted.empty: st.dataframe(submitted[['task_name', 'start_date', 'end_date', 'size', 'description']], column_config=DATE_COLUMN_CONFIG, hide_index=True)
             else: st.caption("無送審任務")
             
             st.divider(); st.markdown("### ✅ 已核可 / ⚠️ 被退回 (歷史紀錄)")
-            # [修正] 年月分層顯示
+            # [修改] 歷史紀錄改為「選年 / 選月 → 分頁清單 → 開啟單一任務」，表單只為開啟的任務建立
             history = pd.concat([approved, rejected])
             if not history.empty:
-                # 確保日期欄位為 datetime
-                history['start_dt'] = pd.to_datetime(history['start_date'], errors='coerce')
-                history['year'] = history['start_dt'].dt.year
-                history['month'] = history['start_dt'].dt.month
-                
-                # 年份排序
-                years = sorted(history['year'].dropna().unique(), reverse=True)
-                
-                for year in years:
-                    with st.expander(f"📅 {int(year)} 年", expanded=False):
-                        current_year_tasks = history[history['year'] == year]
-                        months = sorted(current_year_tasks['month'].dropna().unique(), reverse=True)
-                        
-                        for month in months:
-                            with st.expander(f"🗓️ {int(month)} 月", expanded=False):
-                                monthly_tasks = current_year_tasks[current_year_tasks['month'] == month]
-                                
-                                for i, r in monthly_tasks.iterrows():
-                                    status_icon = "✅" if r['status'] == "Approved" else "⚠️"
-                                    # 任務詳情
-                                    with st.expander(f"{status_icon} {r['task_name']} ({r['points']}點)"):
-                                        if r['status'] == "Rejected":
-                                            st.error(f"主管評語: {r['manager_comment']}")
-                                            with st.form(f"edit_rej_{r['task_id']}"):
-                                                nn = st.text_input("名稱", value=r['task_name']); nd = st.text_input("說明", value=r['description'])
-                                                c1, c2, c3 = st.columns(3)
-                                                ns = c1.date_input("開始", value=pd.to_datetime(r['start_date'])); ne = c2.date_input("結束", value=pd.to_datetime(r['end_date']))
-                                                nz = c3.selectbox("大小", ["S","M","L","XL"], index=["S","M","L","XL"].index(r['size']))
-                                                c_sub, c_del = st.columns(2)
-                                                if c_sub.form_submit_button("🚀 重送"):
-                                                    sys.update_task_content(r['task_id'], nn, nd, ns, ne, nz, "Submitted")
-                                                    st.success("已重送"); time.sleep(1); st.rerun()
-                                                if c_del.form_submit_button("🗑️ 刪除"):
-                                                    sys.delete_task(r['task_id']); st.rerun()
-                                        else:
-                                            # 核可任務
-                                            st.write(f"📅 {r['start_date']} ~ {r['end_date']}")
-                                            exp = calc_expected_progress(r['start_date'], r['end_date'])
-                                            c1, c2 = st.columns(2)
-                                            c1.metric("目前進度", f"{r['progress_pct']}%"); c2.metric("預計進度", f"{exp}%", delta=r['progress_pct']-exp)
-                                            with st.form(f"p_{r['task_id']}"):
-                                                np = st.slider("更新進度", 0, 100, int(r['progress_pct'])); nd = st.text_input("回報說明", max_chars=50)
-                                                if st.form_submit_button("回報"):
-                                                    sys.update_progress(r['task_id'], np, nd); st.rerun()
-            else:
+                history['year'] = history['start_date'].dt.year
+                history['month'] = history['start_date'].dt.month
+                years = sorted(history['year'].dropna().astype(int).unique(), reverse=True)
+
+            if history.empty or not years:
                 st.caption("無歷史紀錄")
+            else:
+                h1, h2 = st.columns(2)
+                sel_year = h1.selectbox("年份", years, format_func=lambda y: f"📅 {y} 年", key="hist_year")
+                year_tasks = history[history['year'] == sel_year]
+                months = sorted(year_tasks['month'].dropna().astype(int).unique(), reverse=True)
+                sel_month = h2.selectbox("月份", months, format_func=lambda m: f"🗓️ {m} 月", key="hist_month")
+                monthly_tasks = year_tasks[year_tasks['month'] == sel_month].sort_values('start_date', ascending=False)
+
+                HIST_ROWS_PER_PAGE = 20
+                if st.session_state.get('hist_sel') != (sel_year, sel_month):
+                    st.session_state.hist_sel = (sel_year, sel_month); st.session_state.hist_page_idx = 0
+                total_pages = max(1, (len(monthly_tasks) - 1) // HIST_ROWS_PER_PAGE + 1)
+                page_idx = min(st.session_state.get('hist_page_idx', 0), total_pages - 1)
+                page_tasks = monthly_tasks.iloc[page_idx * HIST_ROWS_PER_PAGE:(page_idx + 1) * HIST_ROWS_PER_PAGE].copy()
+                page_tasks['預計%'], page_tasks['進度差異'] = calc_expected_progress(page_tasks['start_date'], page_tasks['end_date'], page_tasks['progress_pct'])
+                page_tasks['狀態'] = page_tasks['status'].map(lambda x: "✅ 核可" if x == "Approved" else "⚠️ 退回")
+
+                st.caption(f"{sel_year} 年 {sel_month} 月共 {len(monthly_tasks)} 筆 (第 {page_idx + 1} / {total_pages} 頁)")
+                st.dataframe(page_tasks[['狀態', 'task_name', 'points', 'start_date', 'end_date', 'progress_pct', '預計%']],
+                             column_config={"task_name": "任務名稱", "points": "點數", "start_date": st.column_config.DateColumn("開始"),
+                                            "end_date": st.column_config.DateColumn("結束"), "progress_pct": "目前進度%"},
+                             hide_index=True, use_container_width=True)
+                p1, p2, _ = st.columns([1, 1, 3])
+                if page_idx > 0:
+                    if p1.button("⬅️ 上一頁", key="hist_prev"): st.session_state.hist_page_idx = page_idx - 1; st.rerun()
+                if page_idx < total_pages - 1:
+                    if p2.button("下一頁 ➡️", key="hist_next"): st.session_state.hist_page_idx = page_idx + 1; st.rerun()
+
+                task_opts = ["(請選擇任務)"] + [f"{'✅' if r['status'] == 'Approved' else '⚠️'} {r['task_name']} ({r['points']}點) ({r['task_id']})" for _, r in page_tasks.iterrows()]
+                picked = st.selectbox("開啟任務 (修改 / 回報進度)", task_opts, key="hist_task")
+                if picked != task_opts[0]:
+                    r = page_tasks.iloc[task_opts.index(picked) - 1]
+                    if r['status'] == "Rejected":
+                        st.error(f"主管評語: {r['manager_comment']}")
+                        with st.form(f"edit_rej_{r['task_id']}"):
+                            nn = st.text_input("名稱", value=r['task_name']); nd = st.text_input("說明", value=r['description'])
+                            c1, c2, c3 = st.columns(3)
+                            ns = c1.date_input("開始", value=pd.to_datetime(r['start_date'])); ne = c2.date_input("結束", value=pd.to_datetime(r['end_date']))
+                            nz = c3.selectbox("大小", ["S","M","L","XL"], index=["S","M","L","XL"].index(r['size']))
+                            c_sub, c_del = st.columns(2)
+                            if c_sub.form_submit_button("🚀 重送"):
+                                track_write(sys.update_task_content(r['task_id'], nn, nd, ns, ne, nz, "Submitted"))
+                                st.success("已重送"); time.sleep(1); st.rerun()
+                            if c_del.form_submit_button("🗑️ 刪除"):
+                                track_write(sys.delete_task(r['task_id'])); st.rerun()
+                    else:
+                        # 核可任務
+                        st.write(f"📅 {fmt_date(r['start_date'])} ~ {fmt_date(r['end_date'])}")
+                        c1, c2 = st.columns(2)
+                        c1.metric("目前進度", f"{r['progress_pct']}%"); c2.metric("預計進度", f"{r['預計%']}%", delta=int(r['進度差異']))
+                        with st.form(f"p_{r['task_id']}"):
+                            new_pct = st.slider("更新進度", 0, 100, int(r['progress_pct'])); nd = st.text_input("回報說明", max_chars=50)
+                            if st.form_submit_button("回報"):
+                                track_write(sys.update_progress(r['task_id'], new_pct, nd)); st.rerun()
 
     with t2:
         st.subheader("批次新增任務")
@@ -653,7 +1870,7 @@ def render_personal_task_module(user):
             valid_tasks = edited_tasks[edited_tasks['task_name'] != ""]
             if not valid_tasks.empty:
                 valid_tasks['owner_email'] = user['email']
-                succ, msg = sys.batch_add_tasks(valid_tasks, initial_status="Draft")
+                succ, msg = track_write(sys.batch_add_tasks(valid_tasks, initial_status="Draft"))
                 if succ: st.success(msg); reset_editor(); time.sleep(1); st.rerun()
                 else: st.error(msg)
             else: st.warning("請填寫任務")
@@ -661,7 +1878,7 @@ def render_personal_task_module(user):
             valid_tasks = edited_tasks[edited_tasks['task_name'] != ""]
             if not valid_tasks.empty:
                 valid_tasks['owner_email'] = user['email']
-                succ, msg = sys.batch_add_tasks(valid_tasks, initial_status="Submitted")
+                succ, msg = track_write(sys.batch_add_tasks(valid_tasks, initial_status="Submitted"))
                 if succ: st.success(msg); reset_editor(); time.sleep(1); st.rerun()
                 else: st.error(msg)
             else: st.warning("請填寫任務")
@@ -673,24 +1890,18 @@ def render_personal_task_module(user):
             st.download_button("📥 下載任務範本", buf3, "task_template.xlsx")
             up_t = st.file_uploader("上傳任務 Excel", type=["xlsx"])
             c3, c4 = st.columns(2)
-            if c3.button("匯入並暫存"):
-                if up_t:
-                    df_up = pd.read_excel(up_t)
-                    rename_map = {"任務名稱":"task_name", "說明":"description", "開始日期":"start_date", "結束日期":"end_date", "大小":"size"}
-                    df_up.rename(columns=rename_map, inplace=True)
-                    df_up['owner_email'] = user['email']
-                    succ, msg = sys.batch_add_tasks(df_up, initial_status="Draft")
-                    if succ: st.success(msg)
-                    else: st.error(msg)
-            if c4.button("匯入並送審"):
-                if up_t:
-                    df_up = pd.read_excel(up_t)
-                    rename_map = {"任務名稱":"task_name", "說明":"description", "開始日期":"start_date", "結束日期":"end_date", "大小":"size"}
-                    df_up.rename(columns=rename_map, inplace=True)
-                    df_up['owner_email'] = user['email']
-                    succ, msg = sys.batch_add_tasks(df_up, initial_status="Submitted")
-                    if succ: st.success(msg)
-                    else: st.error(msg)
+            # [修改] 串流匯入：逐批讀取與驗證，回報所有錯誤列，合法列照常新增
+            do_draft, do_submit = c3.button("匯入並暫存"), c4.button("匯入並送審")
+            import_status = "Draft" if do_draft else "Submitted" if do_submit else None
+            if import_status and up_t:
+                with st.spinner("匯入中..."):
+                    succ, msg, import_errors = track_write(sys.import_tasks_excel(up_t, user['email'], initial_status=import_status))
+                if succ: st.success(msg)
+                else: st.error(msg)
+                if not import_errors.empty:
+                    st.warning(f"以下 {len(import_errors)} 列未匯入，請修正後重新上傳")
+                    st.dataframe(import_errors, hide_index=True, use_container_width=True)
+                    st.download_button("📥 下載錯誤明細", import_errors.to_csv(index=False).encode("utf-8-sig"), "task_import_errors.csv", mime="text/csv")
 
     with t3:
         st.subheader("📖 員工 KPI 考核辦法")
@@ -700,7 +1911,7 @@ def render_personal_task_module(user):
 def admin_page():
     st.header("🔧 管理後台")
     change_password_ui("admin", "admin")
-    tab1, tab2, tab3 = st.tabs(["👥 員工管理", "🏢 組織圖", "⚙️ 系統設定"])
+    tab1, tab2, tab3, tab4 = st.tabs(["👥 員工管理", "🏢 組織圖", "⚙️ 系統設定", "📈 點數統計"])
     
     with tab1:
         st.subheader("員工資料維護")
@@ -715,7 +1926,7 @@ def admin_page():
                 ne_mgr = c5.text_input("主管Email")
                 if st.form_submit_button("新增"):
                     if ne_email:
-                        sys.upsert_employee(ne_email, ne_name, ne_pwd, ne_dept, ne_mgr)
+                        track_write(sys.upsert_employee(ne_email, ne_name, ne_pwd, ne_dept, ne_mgr))
                         st.success("已新增"); time.sleep(1); st.rerun()
                     else: st.error("Email 為必填")
         st.write("▼ 直接在表格修改，勾選「刪除」欄位可移除資料")
@@ -726,14 +1937,14 @@ def admin_page():
             edited_df = st.data_editor(df_emp[cols_order], column_config={"刪除": st.column_config.CheckboxColumn(default=False), "email": st.column_config.TextColumn(disabled=True)}, use_container_width=True, hide_index=True)
             if st.button("💾 儲存員工變更", type="primary"):
                 to_keep = edited_df[edited_df['刪除'] == False].drop(columns=['刪除'])
-                succ, msg = sys.save_employees_from_editor(to_keep)
+                succ, msg = track_write(sys.save_employees_from_editor(to_keep))
                 if succ: st.success(msg); time.sleep(1); st.rerun()
                 else: st.error(msg)
         st.divider()
         with st.expander("📂 Excel 批次匯入員工"):
             up = st.file_uploader("上傳 Excel", type=["xlsx"], key="up_e")
             if up and st.button("確認匯入"):
-                sys.batch_import_employees(pd.read_excel(up))
+                track_write(sys.batch_import_employees(pd.read_excel(up)))
                 st.success("匯入完成"); st.rerun()
     with tab2:
         st.subheader("組織資料維護")
@@ -745,7 +1956,7 @@ def admin_page():
                 nd_lv = c3.text_input("層級"); nd_p = c4.text_input("上層代號")
                 if st.form_submit_button("新增"):
                     if nd_id:
-                        sys.upsert_dept(nd_id, nd_name, nd_lv, nd_p)
+                        track_write(sys.upsert_dept(nd_id, nd_name, nd_lv, nd_p))
                         st.success("已新增"); time.sleep(1); st.rerun()
                     else: st.error("代號必填")
         df_dept = sys.get_df("departments")
@@ -755,22 +1966,22 @@ def admin_page():
             edited_dept = st.data_editor(df_dept[cols_order], column_config={"刪除": st.column_config.CheckboxColumn(default=False), "dept_id": st.column_config.TextColumn(disabled=True)}, use_container_width=True, hide_index=True)
             if st.button("💾 儲存組織變更"):
                 to_keep = edited_dept[edited_dept['刪除'] == False].drop(columns=['刪除'])
-                succ, msg = sys.save_depts_from_editor(to_keep)
+                succ, msg = track_write(sys.save_depts_from_editor(to_keep))
                 if succ: st.success(msg); time.sleep(1); st.rerun()
                 else: st.error(msg)
         with st.expander("📂 Excel 批次匯入組織"):
             up_d = st.file_uploader("上傳 Excel", type=["xlsx"], key="up_d")
             if up_d and st.button("確認匯入組織"):
-                sys.batch_import_depts(pd.read_excel(up_d))
+                track_write(sys.batch_import_depts(pd.read_excel(up_d)))
                 st.success("匯入完成"); st.rerun()
 
     with tab3:
         st.subheader("⚙️ 系統設定")
         st.write("設定公司 Logo (圖片)")
         
-        current_logo = sys.get_setting("logo")
+        current_logo = sys.get_logo()
         if current_logo:
-            st.image(current_logo, width=200, caption="目前 Logo")
+            st.image(current_logo['src'], width=200, caption=f"目前 Logo ({current_logo['hash']})")
         
         up_logo = st.file_uploader("上傳新 Logo (建議 < 50KB)", type=["png", "jpg", "jpeg"])
         if up_logo:
@@ -782,7 +1993,7 @@ def admin_page():
                     if len(full_str) > 50000:
                         st.error("圖片過大 (超過 50,000 字元)，請壓縮後再試，或使用 URL 方式。")
                     else:
-                        sys.update_setting("logo", full_str)
+                        track_write(sys.update_setting("logo", full_str))
                         st.success("Logo 已更新！"); time.sleep(1); st.rerun()
                 except Exception as e:
                     st.error(f"處理失敗: {e}")
@@ -792,9 +2003,61 @@ def admin_page():
         logo_url = st.text_input("圖片連結", placeholder="https://example.com/logo.png")
         if st.button("儲存 URL"):
             if logo_url:
-                sys.update_setting("logo", logo_url)
+                track_write(sys.update_setting("logo", logo_url))
                 st.success("Logo URL 已更新"); time.sleep(1); st.rerun()
 
+        st.divider()
+        st.write("資料快取狀態")
+        stats = sys.cache_stats()
+        c1, c2, c3 = st.columns(3)
+        c1.metric("命中", stats['hits']); c2.metric("未命中", stats['misses']); c3.metric("命中率", f"{stats['hit_rate']*100:.1f}%")
+        if stats['tables']:
+            st.dataframe(pd.DataFrame.from_dict(stats['tables'], orient='index').rename(columns={"rows": "筆數", "age": "已快取秒數", "mb": "記憶體 (MB)"}), use_container_width=True)
+        st.caption(f"快取存活時間: {int(stats['ttl'])} 秒 (逾時後比對資料版本，未變更沿用 {stats['revalidated']} 次；目前版本 {stats['version'] or '-'})")
+        if st.button("🔄 清除資料快取"):
+            sys.cache.invalidate()
+            st.success("快取已清除"); time.sleep(1); st.rerun()
+
+        # [新增] API 呼叫監控 (Sheets / Calendar / LINE)
+        st.divider()
+        st.write("API 呼叫監控 (近 1 分鐘 Sheets 用量 / 配額)")
+        usage = sys.telemetry.quota_usage()
+        q1, q2 = st.columns(2)
+        for col, kind, label in [(q1, "read", "讀取"), (q2, "write", "寫入")]:
+            u = usage[kind]
+            col.metric(f"Sheets {label}", f"{u['used']} / {u['quota']}")
+            col.progress(min(u['used'] / u['quota'], 1.0) if u['quota'] else 0.0)
+        ls = sys.limiter.stats
+        st.caption(f"限流排隊 {ls['throttled']} 次 (共等待 {ls['waited_sec']:.1f} 秒)，重試 {ls['retries']} 次，失敗 {ls['failed']} 次")
+        ws = sys.writer.stats
+        st.caption(f"背景寫入 {ws['ops']} 筆變更 → {ws['requests']} 次請求 (同列合併 {ws['coalesced']} 筆)，待寫入 {sys.writer.queue.unfinished_tasks} 筆，失敗 {ws['failed']} 次，取消 {ws['cancelled']} 筆")
+        per_min = sys.telemetry.per_minute()
+        if per_min.empty: st.caption("近 10 分鐘沒有 API 呼叫紀錄")
+        else:
+            st.dataframe(per_min.rename(columns={"minute": "分鐘", "service": "服務", "kind": "類型", "calls": "次數", "errors": "錯誤", "avg_ms": "平均毫秒"}), use_container_width=True, hide_index=True)
+            st.write("呼叫來源 (近 10 分鐘)")
+            st.dataframe(sys.telemetry.by_method().rename(columns={"method": "KPIDB 方法", "service": "服務", "op": "操作", "calls": "次數", "sessions": "session 數", "total_ms": "總毫秒"}), use_container_width=True, hide_index=True)
+        st.download_button("📥 匯出 API 呼叫紀錄 (CSV)", data=sys.telemetry.to_csv, file_name=f"api_calls_{datetime.now().strftime('%Y%m%d_%H%M')}.csv", mime="text/csv")
+
+    # [新增] 全公司核可點數 (部門 x 月 / 季)，由預先彙總的群組產生
+    with tab4:
+        st.subheader("📈 全公司核可點數")
+        points = sys.points_summary()
+        years = sorted({m[:4] for m in points['month'] if m}, reverse=True)
+        if not years: st.info("尚無核可任務")
+        else:
+            c1, c2, c3 = st.columns(3)
+            sel_year = c1.selectbox("年度", years, key="rollup_year")
+            period = c2.radio("彙總", ["月", "季"], horizontal=True, key="rollup_period")
+            metric = c3.radio("指標", ["點數", "任務數"], horizontal=True, key="rollup_metric")
+            year_points = points[points['month'].str.startswith(sel_year)]
+            year_points = year_points.assign(期間=year_points['month'] if period == "月" else
+                                              sel_year + " Q" + ((year_points['month'].str[5:7].astype(int) - 1) // 3 + 1).astype(str))
+            st.dataframe(year_points.pivot_table(index='department', columns='期間', values=metric, aggfunc='sum', fill_value=0, margins=True, margins_name="合計"),
+                         use_container_width=True)
+            st.download_button("📥 匯出明細 (CSV)", data=year_points.drop(columns='期間').to_csv(index=False).encode("utf-8-sig"),
+                               file_name=f"points_{sel_year}.csv", mime="text/csv")
+
 def manager_page():
     user = st.session_state.user
     st.header(f"👨‍💼 主管審核 - {user['name']}")
@@ -806,9 +2069,8 @@ def manager_page():
         render_personal_task_module(user)
     else:
         df_emp = sys.get_df("employees")
-        df_tasks = sys.get_df("tasks")
-        l1_emails = df_emp[df_emp['manager_email'] == user['email']]['email'].tolist()
-        pending = df_tasks[df_tasks['owner_email'].isin(l1_emails) & (df_tasks['status'] == "Submitted")].copy()
+        l1_emails = sys.get_emp_dir().direct_reports(user['email'])
+        pending = sys.get_df("tasks", owner_email=l1_emails, status="Submitted")
         
         pending_count = len(pending)
         if pending_count > 0: st.warning(f"🔔 提醒：您有 **{pending_count}** 筆任務等待審核！")
@@ -830,7 +2092,8 @@ def manager_page():
                 end = start + ROWS_PER_PAGE
                 page_data = pending.iloc[start:end].copy()
                 page_data['審核決定'] = "無動作" 
-                page_data['核定等級'] = page_data['size'] 
+                page_data['size'] = page_data['size'].astype(str)
+                page_data['核定等級'] = page_data['size']
                 page_data['給予點數'] = page_data['size'].map(lambda x: valid_points_map.get(x, [0])[1] if len(valid_points_map.get(x, []))>=2 else 0)
                 page_data['評語'] = ""
                 display_cols = ['task_id', 'owner_email', 'task_name', 'description', 'start_date', 'end_date', 'size', '核定等級', '給予點數', '評語', '審核決定']
@@ -841,6 +2104,7 @@ def manager_page():
                         "owner_email": st.column_config.TextColumn("申請人", disabled=True),
                         "task_name": st.column_config.TextColumn("任務", disabled=True),
                         "description": st.column_config.TextColumn("說明", disabled=True),
+                        **DATE_COLUMN_CONFIG,
                         "size": st.column_config.TextColumn("申請", disabled=True),
                         "核定等級": st.column_config.SelectboxColumn("核定", options=["S", "M", "L", "XL"], required=True),
                         "給予點數": st.column_config.SelectboxColumn("點數", options=list(range(13)), required=True),
@@ -869,63 +2133,108 @@ def manager_page():
                             updates.append({"task_id": r['task_id'], "status": "Rejected", "comment": r['評語']})
                     if has_error: st.error(error_msg)
                     elif updates:
-                        succ, msg = sys.batch_update_tasks_status(updates)
+                        succ, msg = track_write(sys.batch_update_tasks_status(updates))
                         if succ: st.success(f"已處理 {len(updates)} 筆"); time.sleep(1); st.rerun()
                         else: st.error(msg)
                     else: st.warning("無動作")
 
         with t2:
-            st.subheader("團隊任務總表 (含 L1 & L2)")
-            full_team_emails = get_full_team_emails(user['email'], df_emp)
+            # [修改] 由組織索引取得任意層數的下屬 (不再只看兩層)
+            team_levels = sys.get_emp_dir().levels(user['email'])
+            st.subheader(f"團隊任務總表 (共 {len(team_levels)} 層)")
+            show_depth = len(team_levels)
+            if len(team_levels) > 1:
+                depth_opts = [f"全部 (L1 ~ L{len(team_levels)})"] + [f"L1 ~ L{i}" if i > 1 else "僅 L1" for i in range(1, len(team_levels))]
+                show_depth = depth_opts.index(st.selectbox("顯示層級", depth_opts)) or len(team_levels)
+            full_team_emails = [e for level in team_levels[:show_depth] for e in level]
             if full_team_emails:
-                team_tasks = df_tasks[df_tasks['owner_email'].isin(full_team_emails)].copy()
+                team_tasks = sys.get_df("tasks", owner_email=full_team_emails)
                 merged_df = team_tasks.merge(df_emp[['email', 'name', 'department']], left_on='owner_email', right_on='email', how='left')
-                merged_df['預計%'] = merged_df.apply(lambda x: calc_expected_progress(x['start_date'], x['end_date']), axis=1)
-                merged_df['進度差異'] = merged_df['progress_pct'] - merged_df['預計%']
+                merged_df['預計%'], merged_df['進度差異'] = calc_expected_progress(merged_df['start_date'], merged_df['end_date'], merged_df['progress_pct'])
                 
-                filter_status = st.radio("顯示狀態", ["全部", "進行中 (Approved)", "已完成 (Completed)"], horizontal=True)
-                if filter_status == "進行中 (Approved)": display_df = merged_df[merged_df['status'] == 'Approved']
-                elif filter_status == "已完成 (Completed)": display_df = merged_df[merged_df['status'] == 'Completed']
-                else: display_df = merged_df
-
-                unique_depts = display_df['department'].unique()
-                for dept in unique_depts:
-                    # 第一層：部門
-                    with st.expander(f"🏢 {dept}", expanded=True):
-                        dept_data = display_df[display_df['department'] == dept]
-                        
-                        # 取得該部門下的人員姓名
-                        unique_people = dept_data['name'].unique()
-                        
-                        for person_name in unique_people:
-                            person_data = dept_data[dept_data['name'] == person_name].sort_values(by='進度差異')
-                            
-                            # 計算該員統計數據
-                            p_count = len(person_data)
-                            p_points = person_data['points'].sum()
-                            
-                            # 第二層：人員 (預設縮起 expanded=False)
-                            with st.expander(f"👤 {person_name} ({p_count} 筆 / 共 {p_points} 點)", expanded=False):
-                                cols_to_show = ['task_name', 'start_date', 'end_date', 'points', 'status', 'progress_pct', '預計%', '進度差異', 'progress_desc']
-                                
-                                def highlight_delay(val):
-                                    if val < -20: return 'background-color: #ffcccc; color: red'
-                                    elif val < -5: return 'color: red'
-                                    return ''
-
-                                st.dataframe(
-                                    person_data[cols_to_show].style.map(highlight_delay, subset=['進度差異']),
-                                    column_config={
-                                        "task_name": "任務名稱", 
-                                        "start_date": "開始",
-                                        "end_date": "結束",
-                                        "points": "點數",
-                                        "status": "狀態",
-                                        "progress_pct": "回報%", 
-                                        "progress_desc": "進度說明"
-                                    },
-                                    use_container_width=True
-                                )
+                merged_df['name'] = merged_df['name'].fillna(merged_df['owner_email'])
+                merged_df['department'] = merged_df['department'].fillna("(未設定)").replace("", "(未設定)")
+                # [新增] 全團隊 xlsx 報表 (點擊時才產生)
+                st.download_button("📥 下載報表", data=lambda: write_team_report(merged_df), file_name=f"team_report_{date.today()}.xlsx",
+                                   mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+
+                # [新增] 核可點數走勢：讀取預先彙總的 (成員, 月份) 群組，不重新加總任務
+                with st.expander("📈 團隊核可點數 (依月份)"):
+                    team_points = sys.points_summary(full_team_emails)
+                    if team_points.empty: st.caption("尚無核可任務")
+                    else:
+                        st.bar_chart(team_points.pivot_table(index='month', columns='department', values='點數', aggfunc='sum', fill_value=0))
+                        st.dataframe(team_points.groupby(['department', 'name', 'owner_email'], as_index=False)[['任務數', '點數']].sum().sort_values('點數', ascending=False),
+                                     column_config={"department": "部門", "name": "姓名", "owner_email": "Email", "任務數": "核可任務數", "點數": "核可點數"},
+                                     use_container_width=True, hide_index=True)
+
+                def highlight_delay(val):
+                    if val < -20: return 'background-color: #ffcccc; color: red'
+                    elif val < -5: return 'color: red'
+                    return ''
+
+                # [修改] 摘要優先：先顯示每人彙總表 (篩選與分頁在伺服器端完成)，個人明細僅在選取時產生
+                f1, f2, f3 = st.columns(3)
+                filter_status = f1.radio("顯示狀態", ["全部", "進行中 (Approved)", "已完成 (Completed)"], horizontal=True)
+                filter_dept = f2.selectbox("部門", ["全部部門"] + sorted(merged_df['department'].astype(str).unique().tolist()))
+                keyword = f3.text_input("搜尋成員 (姓名 / Email)").strip()
+                display_df = merged_df
+                if filter_status == "進行中 (Approved)": display_df = display_df[display_df['status'] == 'Approved']
+                elif filter_status == "已完成 (Completed)": display_df = display_df[display_df['status'] == 'Completed']
+                if filter_dept != "全部部門": display_df = display_df[display_df['department'] == filter_dept]
+                if keyword:
+                    display_df = display_df[display_df['name'].astype(str).str.contains(keyword, case=False, regex=False) |
+                                            display_df['owner_email'].str.contains(keyword.lower(), regex=False)]
+
+                summary = (display_df.assign(進行中=display_df['status'] == 'Approved', 已完成=display_df['status'] == 'Completed', 落後件數=display_df['進度差異'] < -5)
+                           .groupby(['department', 'name', 'owner_email'], sort=False)
+                           .agg(任務數=('task_id', 'size'), 總點數=('points', 'sum'), 進行中=('進行中', 'sum'), 已完成=('已完成', 'sum'),
+                                落後件數=('落後件數', 'sum'), 最大落後=('進度差異', 'min'))
+                           .reset_index().sort_values(['最大落後', 'department', 'name']))
+
+                TEAM_ROWS_PER_PAGE = 25
+                if 'team_page_idx' not in st.session_state: st.session_state.team_page_idx = 0
+                filter_sig = (show_depth, filter_status, filter_dept, keyword)
+                if st.session_state.get('team_filter_sig') != filter_sig:
+                    st.session_state.team_filter_sig = filter_sig; st.session_state.team_page_idx = 0
+                total_pages = max(1, (len(summary) - 1) // TEAM_ROWS_PER_PAGE + 1)
+                if st.session_state.team_page_idx >= total_pages: st.session_state.team_page_idx = 0
+                page_start = st.session_state.team_page_idx * TEAM_ROWS_PER_PAGE
+                page_summary = summary.iloc[page_start:page_start + TEAM_ROWS_PER_PAGE]
+
+                if summary.empty: st.info("沒有符合條件的任務")
+                else:
+                    st.caption(f"共 {len(summary)} 位成員 / {len(display_df)} 筆任務 (第 {st.session_state.team_page_idx + 1} / {total_pages} 頁，依最大落後排序)")
+                    st.dataframe(
+                        page_summary.style.map(highlight_delay, subset=['最大落後']),
+                        column_config={"department": "部門", "name": "姓名", "owner_email": "Email"},
+                        use_container_width=True, hide_index=True
+                    )
+                    p1, p2, _ = st.columns([1, 1, 3])
+                    if st.session_state.team_page_idx > 0:
+                        if p1.button("⬅️ 上一頁", key="team_prev"): st.session_state.team_page_idx -= 1; st.rerun()
+                    if st.session_state.team_page_idx < total_pages - 1:
+                        if p2.button("下一頁 ➡️", key="team_next"): st.session_state.team_page_idx += 1; st.rerun()
+
+                    person_opts = ["(請選擇成員)"] + [f"{n} ({e})" for n, e in zip(page_summary['name'], page_summary['owner_email'])]
+                    picked = st.selectbox("👤 查看成員任務明細", person_opts)
+                    if picked != person_opts[0]:
+                        picked_email = page_summary['owner_email'].iloc[person_opts.index(picked) - 1]
+                        person_data = display_df[display_df['owner_email'] == picked_email].sort_values(by='進度差異')
+                        cols_to_show = ['task_name', 'start_date', 'end_date', 'points', 'status', 'progress_pct', '預計%', '進度差異', 'progress_desc']
+                        st.dataframe(
+                            person_data[cols_to_show].style.map(highlight_delay, subset=['進度差異']),
+                            column_config={
+                                "task_name": "任務名稱", 
+                                "start_date": st.column_config.DateColumn("開始"),
+                                "end_date": st.column_config.DateColumn("結束"),
+                                "points": "點數",
+                                "status": "狀態",
+                                "progress_pct": "回報%", 
+                                "progress_desc": "進度說明"
+                            },
+                            use_container_width=True
+                        )
                 # --- [修改區段結束] ---
             else: st.info("您目前沒有下屬資料")
 
@@ -954,31 +2263,40 @@ def employee_page():
 # --- Entry ---
 if 'user' not in st.session_state: st.session_state.user = None
 
-logo_data = sys.get_setting("logo")
+# [修改] Logo 由設定快取取得 (已解碼的 bytes)，不再每次 rerun 查表與傳送 base64 字串
+try: logo = sys.get_logo()
+except KPIDBError: logo = None  # Logo 非必要，讀取失敗時略過
 with st.sidebar:
-    if logo_data:
-        try:
-            if logo_data.startswith("http"): st.image(logo_data, use_column_width=True)
-            else:
-                if not logo_data.startswith("data:image"): logo_data = f"data:image/png;base64,{logo_data}"
-                st.image(logo_data, use_column_width=True)
+    if logo:
+        try: st.image(logo['src'], use_container_width=True)
         except: pass
     st.divider()
 
-if st.session_state.user is None:
-    login_page()
-else:
-    role = st.session_state.user['role']
-    with st.sidebar:
-        st.write(f"👤 {st.session_state.user['name']}")
-        if st.button("登出"): st.session_state.user = None; st.rerun()
-    if role == "admin": admin_page()
+# [新增] 資料讀取失敗 (重試後仍失敗 / 配額已滿) 時明確提示，而不是顯示空資料
+try:
+    if st.session_state.user is None:
+        login_page()
     else:
-        df_emp = sys.get_df("employees")
-        is_mgr = not df_emp[df_emp['manager_email'] == st.session_state.user['email']].empty
-        if is_mgr: manager_page()
-        else: 
-            employee_page()
+        role = st.session_state.user['role']
+        with st.sidebar:
+            st.write(f"👤 {st.session_state.user['name']}")
+            # [新增] 背景寫入狀態 (變更已先顯示，試算表在背景依序寫入)
+            write_status = sys.write_status()
+            ticket = st.session_state.get('write_ticket')
+            if write_status['pending']: st.caption(f"⏳ 儲存中：{write_status['pending']} 筆變更")
+            elif ticket is not None and ticket.done():
+                if ticket.result()[0]: st.caption("✅ 變更已儲存")
+                del st.session_state['write_ticket']
+            for msg in write_status['failed']: st.error(f"⚠️ {msg}")
+            if st.button("登出"): st.session_state.user = None; st.rerun()
+        if role == "admin": admin_page()
+        else:
+            is_mgr = sys.get_emp_dir().is_manager(st.session_state.user['email'])
+            if is_mgr: manager_page()
+            else: 
+                employee_page()
+except KPIDBError as e:
+    st.error(f"⚠️ 資料服務暫時無法使用，請稍後重新整理頁面。({e})")
 
 
 
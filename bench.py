@@ -0,0 +1,168 @@
+"""頁面效能基準測試 (離線)
+
+以 fake_sheets 取代 Google Sheets，於合成資料 (預設 1k / 10k / 100k 筆任務) 上
+透過 streamlit AppTest 執行登入、員工、主管、管理員頁面，
+統計每次 rerun 的 Sheets API 呼叫次數與耗時；另量測冷啟動 (連線 + 初次載入 + 登入頁) 的平均耗時。
+
+--ttl 0 讓每次讀表都先比對資料版本，可觀察閒置 rerun 的成本 (未變更時只有 get_lastUpdateTime)。
+
+用法: python bench.py [--sizes 1000,10000] [--latency 0.05] [--row-latency 0.00001] [--cold-runs 3] [--ttl 0] [--out bench_output.txt]
+"""
+import os
+import time
+import random
+import argparse
+from datetime import date, timedelta
+
+import streamlit as st
+from streamlit.testing.v1 import AppTest
+
+import fake_sheets
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+TASK_HEADER = ['task_id', 'owner_email', 'task_name', 'description', 'start_date', 'end_date', 'size', 'points', 'status', 'progress_pct', 'progress_desc', 'manager_comment', 'created_at', 'approved_at']
+EMP_HEADER = ["email", "name", "password", "department", "manager_email", "role", "line_token"]
+SIZE_POINTS = {"S": 2, "M": 5, "L": 8, "XL": 11}
+STATUSES = ["Draft", "Submitted", "Approved", "Completed", "Rejected"]
+STATUS_WEIGHTS = [10, 15, 45, 25, 5]
+
+DIRECTOR = "director@bench.local"
+ADMIN_PASSWORD = "admin-pw"
+USER_PASSWORD = "1234"
+
+
+def make_tables(n_tasks, n_managers=10, staff_per_manager=29, seed=42):
+    """產生合成資料：1 位總監、n_managers 位主管、每位主管 staff_per_manager 位員工，任務隨機分配"""
+    rnd = random.Random(seed)
+    emps = [EMP_HEADER, [DIRECTOR, "總監", USER_PASSWORD, "HQ", "", "user", ""]]
+    owners = []
+    for m in range(n_managers):
+        mgr = f"mgr{m:02d}@bench.local"
+        emps.append([mgr, f"主管{m:02d}", USER_PASSWORD, f"D{m:02d}", DIRECTOR, "user", ""])
+        owners.append(mgr)
+        for s in range(staff_per_manager):
+            email = f"staff{m:02d}{s:03d}@bench.local"
+            emps.append([email, f"員工{m:02d}{s:03d}", USER_PASSWORD, f"D{m:02d}", mgr, "user", ""])
+            owners.append(email)
+    depts = [["dept_id", "dept_name", "level", "parent_dept_id"], ["HQ", "總部", "1", ""]]
+    depts += [[f"D{m:02d}", f"部門{m:02d}", "2", "HQ"] for m in range(n_managers)]
+
+    tasks = [TASK_HEADER]
+    base = date(2025, 1, 1)
+    for i in range(n_tasks):
+        status = rnd.choices(STATUSES, STATUS_WEIGHTS)[0]
+        size = rnd.choice(list(SIZE_POINTS))
+        start = base + timedelta(days=rnd.randrange(365))
+        end = start + timedelta(days=rnd.randrange(7, 90))
+        done = status in ("Approved", "Completed")
+        pct = 100 if status == "Completed" else rnd.randrange(0, 100, 10)
+        tasks.append([f"T{i:07d}", rnd.choice(owners), f"任務 {i}", "合成資料", start.isoformat(), end.isoformat(), size,
+                      SIZE_POINTS[size] if done else 0, status, pct, "", "", start.isoformat(), end.isoformat() if done else ""])
+    return {"employees": emps, "departments": depts, "tasks": tasks,
+            "system_settings": [["key", "value"], ["logo", ""]], "system_admin": [["admin", ADMIN_PASSWORD]]}
+
+
+def new_app(user=None, quota=None, ttl=None):
+    at = AppTest.from_file(APP_PATH, default_timeout=600)
+    if quota: at.secrets["quota_config"] = {"read_per_minute": quota, "write_per_minute": quota}
+    if ttl is not None: at.secrets["cache_config"] = {"ttl_seconds": ttl, "poll_seconds": ttl}
+    at.secrets["gcp_service_account"] = {"type": "service_account"}
+    at.secrets["sheet_config"] = {"spreadsheet_url": "https://docs.google.com/spreadsheets/d/fake"}
+    at.secrets["line_config"] = {"channel_access_token": ""}
+    if user: at.session_state["user"] = user
+    return at
+
+
+def measure(backend, fn):
+    """執行一次 rerun，回傳 (API 呼叫明細, 耗時秒)"""
+    backend.reset()
+    t0 = time.perf_counter()
+    at = fn()
+    elapsed = time.perf_counter() - t0
+    if at.exception: raise RuntimeError(at.exception[0].message)
+    return backend.snapshot(), elapsed
+
+
+def scenarios():
+    """每個情境為 (名稱, 使用者)；使用者 None 表示從登入頁開始"""
+    mgr = {"role": "user", "name": "主管00", "email": "mgr00@bench.local", "manager": DIRECTOR}
+    staff = {"role": "user", "name": "員工00000", "email": "staff00000@bench.local", "manager": "mgr00@bench.local"}
+    return [("login_page", None),
+            ("employee_page", staff),
+            ("manager_page", mgr),
+            ("manager_page (director)", {"role": "user", "name": "總監", "email": DIRECTOR, "manager": ""}),
+            ("admin_page", {"role": "admin", "name": "管理員", "email": "admin"})]
+
+
+def run_scenario(backend, name, user, reruns, quota=None, ttl=None):
+    """cold = 清空快取後第一次 rerun；warm = 同一 session 後續 rerun 的平均"""
+    st.cache_resource.clear(); st.cache_data.clear()
+    at = new_app(user, quota, ttl)
+    results = [("cold", *measure(backend, at.run))]
+    if user is None:
+        # 登入頁：輸入帳密並按下登入 (含登入後 st.rerun 的頁面)
+        at.text_input[0].input("staff00000@bench.local"); at.text_input[1].input(USER_PASSWORD)
+        login_btn = next(b for b in at.button if b.label == "登入")
+        results.append(("login", *measure(backend, login_btn.click().run)))
+    for _ in range(reruns):
+        results.append(("warm", *measure(backend, at.run)))
+    return results
+
+
+def run_cold_start(backend, runs, quota=None, ttl=None):
+    """冷啟動：清空 cache_resource (等同容器重啟) 後第一次開啟登入頁，回傳 runs 次的 (API 呼叫明細, 平均耗時, 最短耗時)"""
+    walls, calls = [], {}
+    for _ in range(runs):
+        st.cache_resource.clear(); st.cache_data.clear()
+        calls, wall = measure(backend, new_app(None, quota, ttl).run)
+        walls.append(wall)
+    return calls, sum(walls) / len(walls), min(walls)
+
+
+def fmt_calls(calls):
+    return ", ".join(f"{op}={n}" for op, n in sorted(calls.items())) or "-"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="KPI 系統頁面效能基準測試 (離線 Sheets)")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="任務筆數，逗號分隔")
+    parser.add_argument("--latency", type=float, default=0.0, help="每次 API 呼叫注入的延遲 (秒)")
+    parser.add_argument("--row-latency", type=float, default=0.0, help="讀取時每列額外延遲 (秒)")
+    parser.add_argument("--quota", type=int, default=1000000, help="每分鐘讀 / 寫配額 (預設不限流；0 = 使用 app 預設值)")
+    parser.add_argument("--reruns", type=int, default=3, help="每個情境的 warm rerun 次數")
+    parser.add_argument("--cold-runs", type=int, default=3, help="冷啟動量測次數 (0 = 略過)")
+    parser.add_argument("--ttl", type=float, help="快取逾時秒數 (預設使用 app 設定；0 = 每次 rerun 都比對資料版本)")
+    parser.add_argument("--out", help="另存結果的檔案 (例如 bench_output.txt)")
+    args = parser.parse_args()
+
+    lines = [f"latency={args.latency}s row_latency={args.row_latency}s reruns={args.reruns} quota={args.quota or 'default'} ttl={args.ttl if args.ttl is not None else 'default'}",
+             f"{'tasks':>7}  {'page':<24} {'phase':<5} {'calls':>5} {'reads':>5} {'writes':>6} {'wall_ms':>9}  detail"]
+    print("\n".join(lines), flush=True)
+    for size in [int(s) for s in args.sizes.split(",") if s.strip()]:
+        backend, _ = fake_sheets.install(make_tables(size), latency=args.latency, row_latency=args.row_latency)
+        if args.cold_runs:
+            calls, avg_wall, min_wall = run_cold_start(backend, args.cold_runs, args.quota, args.ttl)
+            reads, writes = backend.reads_writes(calls)
+            line = (f"{size:>7}  {'cold_start':<24} {'cold':<5} {sum(calls.values()):>5} {reads:>5} {writes:>6} {avg_wall * 1000:>9.1f}  "
+                    f"{fmt_calls(calls)} (min {min_wall * 1000:.1f} ms / {args.cold_runs} runs)")
+            lines.append(line); print(line, flush=True)
+        for name, user in scenarios():
+            rows = run_scenario(backend, name, user, args.reruns, args.quota, args.ttl)
+            warm = [r for r in rows if r[0] == "warm"]
+            if warm:
+                # warm 取平均，明細取最後一次
+                avg_calls = sum(sum(c.values()) for _, c, _ in warm) / len(warm)
+                avg_wall = sum(t for _, _, t in warm) / len(warm)
+                rows = [r for r in rows if r[0] != "warm"] + [("warm", warm[-1][1], avg_wall, avg_calls)]
+            for phase, calls, wall, *avg in rows:
+                reads, writes = backend.reads_writes(calls)
+                total = avg[0] if avg else sum(calls.values())
+                line = f"{size:>7}  {name:<24} {phase:<5} {total:>5g} {reads:>5} {writes:>6} {wall * 1000:>9.1f}  {fmt_calls(calls)}"
+                lines.append(line); print(line, flush=True)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f: f.write("\n".join(lines) + "\n")
+
+
+if __name__ == "__main__":
+    main()
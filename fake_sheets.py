@@ -0,0 +1,226 @@
+"""離線 Google Sheets 模擬 (benchmark / 本機開發用)
+
+模擬 KPIDB 會用到的 gspread 介面 (Client / Spreadsheet / Worksheet)，
+資料存在記憶體中，並記錄每種 API 呼叫次數，可注入延遲以估算真實環境的耗時。
+"""
+import re
+import json
+import time
+import threading
+from collections import Counter
+
+import gspread
+import requests
+from gspread.exceptions import APIError
+from gspread.cell import Cell
+from gspread.utils import a1_range_to_grid_range, numericise_all
+from google.oauth2.service_account import Credentials
+
+
+class FakeSheetsBackend:
+    """共用的呼叫計數與延遲設定。
+    latency: 每次呼叫固定延遲 (秒)；op_latency: 個別操作延遲；row_latency: 讀取時每列額外延遲"""
+    READ_OPS = {"get_all_records", "get_all_values", "find", "cell", "row_values", "col_values", "worksheet", "worksheets",
+                "values_batch_get", "values_get", "fetch_sheet_metadata", "get_lastUpdateTime", "open_by_url"}
+
+    def __init__(self, latency=0.0, op_latency=None, row_latency=0.0):
+        self.latency = latency
+        self.op_latency = op_latency or {}
+        self.row_latency = row_latency
+        self.calls = Counter()
+        self.lock = threading.RLock()
+        self.modified = 0
+        self.failures = {}  # op -> [HTTP 狀態碼, 剩餘次數]
+
+    def fail(self, op, code=429, times=1):
+        """接下來 times 次 op 呼叫拋出 APIError (op="*" 表示任何操作)"""
+        with self.lock: self.failures[op] = [code, times]
+
+    @staticmethod
+    def api_error(code):
+        resp = requests.Response()
+        resp.status_code = code
+        resp._content = json.dumps({"error": {"code": code, "message": "fake error", "status": "FAKE"}}).encode()
+        return APIError(resp)
+
+    def hit(self, op, rows=0):
+        with self.lock:
+            self.calls[op] += 1
+            rule = self.failures.get(op) or self.failures.get("*")
+            if rule and rule[1] > 0:
+                rule[1] -= 1
+                raise self.api_error(rule[0])
+        delay = self.op_latency.get(op, self.latency) + self.row_latency * rows
+        if delay: time.sleep(delay)
+
+    def touch(self):
+        with self.lock: self.modified += 1
+
+    def reset(self):
+        with self.lock: self.calls.clear()
+
+    def snapshot(self):
+        with self.lock: return dict(self.calls)
+
+    def reads_writes(self, calls=None):
+        calls = self.snapshot() if calls is None else calls
+        reads = sum(n for op, n in calls.items() if op in self.READ_OPS)
+        return reads, sum(calls.values()) - reads
+
+
+class FakeWorksheet:
+    def __init__(self, backend, spreadsheet, title, sheet_id, rows=None):
+        self.backend = backend
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.id = sheet_id
+        self.rows = [list(r) for r in (rows or [])]
+
+    def _padded(self):
+        width = max((len(r) for r in self.rows), default=0)
+        return [list(r) + [""] * (width - len(r)) for r in self.rows]
+
+    def _set(self, row, col, value):
+        while len(self.rows) < row: self.rows.append([])
+        r = self.rows[row - 1]
+        while len(r) < col: r.append("")
+        r[col - 1] = value
+
+    def _write_range(self, range_name, values):
+        if "!" in range_name: range_name = range_name.split("!", 1)[1]
+        start = re.match(r"[A-Z]+\d+", range_name).group(0)
+        g = a1_range_to_grid_range(start)
+        for i, row in enumerate(values):
+            for j, v in enumerate(row): self._set(g["startRowIndex"] + 1 + i, g["startColumnIndex"] + 1 + j, v)
+        self.backend.touch()
+
+    # --- 讀取 ---
+    def get_all_records(self, **kwargs):
+        self.backend.hit("get_all_records", len(self.rows))
+        vals = self._padded()
+        if not vals: return []
+        head = vals[0]
+        if "all" in (kwargs.get("numericise_ignore") or []): return [dict(zip(head, [str(v) for v in r])) for r in vals[1:]]
+        return [dict(zip(head, numericise_all([v if isinstance(v, (int, float)) else str(v) for v in r]))) for r in vals[1:]]
+
+    def get_all_values(self, **kwargs):
+        self.backend.hit("get_all_values", len(self.rows))
+        return [[str(v) for v in r] for r in self._padded()]
+
+    def find(self, query, in_column=None, **kwargs):
+        # 與 gspread 相同：先下載整張表再於本機搜尋
+        self.backend.hit("find", len(self.rows))
+        for i, r in enumerate(self.rows):
+            cols = [in_column - 1] if in_column else range(len(r))
+            for c in cols:
+                if c < len(r) and str(r[c]) == str(query): return Cell(i + 1, c + 1, str(r[c]))
+        return None
+
+    def cell(self, row, col, **kwargs):
+        self.backend.hit("cell")
+        r = self.rows[row - 1] if row - 1 < len(self.rows) else []
+        return Cell(row, col, str(r[col - 1]) if col - 1 < len(r) else "")
+
+    def row_values(self, row, **kwargs):
+        self.backend.hit("row_values")
+        return [str(v) for v in self.rows[row - 1]] if row - 1 < len(self.rows) else []
+
+    def col_values(self, col, **kwargs):
+        self.backend.hit("col_values", len(self.rows))
+        return [str(r[col - 1]) if col - 1 < len(r) else "" for r in self.rows]
+
+    # --- 寫入 ---
+    def update_cell(self, row, col, value):
+        self.backend.hit("update_cell")
+        self._set(row, col, value); self.backend.touch()
+
+    def update(self, values=None, range_name=None, **kwargs):
+        self.backend.hit("update", len(values or []) if not isinstance(values, str) else 0)
+        if isinstance(values, str): values, range_name = range_name, values
+        self._write_range(range_name or "A1", values)
+
+    def batch_update(self, data, **kwargs):
+        self.backend.hit("batch_update")
+        for d in data: self._write_range(d["range"], d["values"])
+
+    def append_row(self, values, **kwargs):
+        self.backend.hit("append_row")
+        self.rows.append(list(values)); self.backend.touch()
+
+    def append_rows(self, values, **kwargs):
+        self.backend.hit("append_rows", len(values))
+        start = len(self.rows) + 1
+        for v in values: self.rows.append(list(v))
+        self.backend.touch()
+        return {"updates": {"updatedRange": f"'{self.title}'!A{start}:N{len(self.rows)}", "updatedRows": len(values)}}
+
+    def clear(self):
+        self.backend.hit("clear")
+        self.rows = []; self.backend.touch()
+
+    def delete_rows(self, start_index, end_index=None):
+        self.backend.hit("delete_rows")
+        del self.rows[start_index - 1:end_index or start_index]; self.backend.touch()
+
+
+class FakeSpreadsheet:
+    def __init__(self, backend, tables):
+        self.backend = backend
+        self.id = "fake-spreadsheet"
+        self._sheets = {title: FakeWorksheet(backend, self, title, i, rows) for i, (title, rows) in enumerate(tables.items())}
+
+    def worksheet(self, title):
+        self.backend.hit("worksheet")
+        return self._sheets[title]
+
+    def worksheets(self, exclude_hidden=False):
+        self.backend.hit("worksheets")
+        return list(self._sheets.values())
+
+    def batch_update(self, body):
+        self.backend.hit("spreadsheet_batch_update")
+        by_id = {ws.id: ws for ws in self._sheets.values()}
+        for req in body.get("requests", []):
+            if "deleteDimension" in req:
+                rng = req["deleteDimension"]["range"]
+                del by_id[rng["sheetId"]].rows[rng["startIndex"]:rng["endIndex"]]
+        self.backend.touch()
+        return {"spreadsheetId": self.id, "replies": [{} for _ in body.get("requests", [])]}
+
+    def values_batch_get(self, ranges, params=None):
+        """ranges 為 "'表名'" (整表) 或 "'表名'!A5:B7" 形式"""
+        out = []
+        total = 0
+        for rng in ranges:
+            title, _, cells = rng.partition("!")
+            rows = self._sheets[title.strip("'")].rows
+            if cells:
+                g = a1_range_to_grid_range(cells)
+                c0, c1 = g.get("startColumnIndex", 0), g.get("endColumnIndex")
+                rows = [r[c0:c1] for r in rows[g.get("startRowIndex", 0):g.get("endRowIndex")]]
+            total += len(rows)
+            out.append({"range": rng, "majorDimension": "ROWS", "values": [[str(v) for v in r] for r in rows]})
+        self.backend.hit("values_batch_get", total)
+        return {"spreadsheetId": self.id, "valueRanges": out}
+
+    def get_lastUpdateTime(self):
+        self.backend.hit("get_lastUpdateTime")
+        return f"2025-01-01T00:00:{self.backend.modified:09d}Z"
+
+
+class FakeClient:
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+
+    def open_by_url(self, url):
+        self.spreadsheet.backend.hit("open_by_url")
+        return self.spreadsheet
+
+
+def install(tables, **backend_kwargs):
+    """以假的試算表取代 gspread.authorize / 服務帳戶憑證，回傳 (backend, spreadsheet)"""
+    backend = FakeSheetsBackend(**backend_kwargs)
+    spreadsheet = FakeSpreadsheet(backend, tables)
+    gspread.authorize = lambda creds, **kwargs: FakeClient(spreadsheet)
+    Credentials.from_service_account_info = classmethod(lambda cls, info, **kwargs: object())
+    return backend, spreadsheet
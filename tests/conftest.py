@@ -0,0 +1,39 @@
+"""離線測試設定：以 SQLite (:memory:) 引擎載入 app，不需要 Google 憑證"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECRETS = """[storage]
+engine = "sqlite"
+sqlite_path = ":memory:"
+admin_password = "admin-pw"
+
+[line_config]
+channel_access_token = ""
+"""
+
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    # st.secrets 讀取工作目錄下的 .streamlit/secrets.toml，須在匯入 app (與 streamlit) 前切換
+    work = tmp_path_factory.mktemp("app")
+    (work / ".streamlit").mkdir()
+    (work / ".streamlit" / "secrets.toml").write_text(SECRETS, encoding="utf-8")
+    os.chdir(work)
+    sys.path.insert(0, ROOT)
+    import app as app_module
+    return app_module
+
+
+@pytest.fixture
+def db(app):
+    """每個測試一個全新的 KPIDB (各自的 :memory: 資料庫)，預先建立一位主管與一位員工"""
+    kpidb = app.KPIDB()
+    emps = [{"email": "mgr@x.com", "name": "Mgr", "password": "1", "department": "D1", "manager_email": "", "role": "user"},
+            {"email": "e1@x.com", "name": "E1", "password": "1", "department": "D1", "manager_email": "mgr@x.com", "role": "user"}]
+    ok, msg = kpidb.save_employees_from_editor(app.pd.DataFrame(emps))
+    assert ok, msg
+    kpidb.writer.flush()
+    return kpidb
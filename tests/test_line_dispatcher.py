@@ -0,0 +1,83 @@
+"""LineDispatcher 對本機 http.server 假 LINE API：重試、multicast 合併與失敗回報"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+class StubLine(ThreadingHTTPServer):
+    """依序回傳 statuses 中的狀態碼 (用完後回 200)，記錄每次請求的 (路徑, 內容)"""
+    def __init__(self, statuses):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.statuses = list(statuses)
+        self.requests = []
+        self.lock = threading.Lock()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with self.server.lock:
+            self.server.requests.append((self.path, body))
+            status = self.server.statuses.pop(0) if self.server.statuses else 200
+        self.send_response(status)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, *args): pass
+
+
+@pytest.fixture
+def stub():
+    servers = []
+    def start(statuses):
+        server = StubLine(statuses)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+    yield start
+    for server in servers: server.shutdown(); server.server_close()
+
+
+def dispatcher(app, server, reports, **kwargs):
+    kwargs.setdefault("workers", 1)
+    return app.LineDispatcher("token", api_base=f"http://127.0.0.1:{server.server_address[1]}", backoff=0.01,
+                              telemetry=app.ApiTelemetry(), report=lambda session, msg: reports.append((session, msg)), **kwargs)
+
+
+def test_retry_then_multicast_grouping(app, stub):
+    server, reports = stub([503]), []
+    line = dispatcher(app, server, reports)
+    line.submit({"U1": "已核准", "U2": "已核准", "U3": "被退回"})
+    assert line.flush(timeout=10)
+
+    assert line.stats == {"sent": 2, "failed": 0, "dropped": 0, "retries": 1}
+    multicasts = [body for path, body in server.requests if path == "/v2/bot/message/multicast"]
+    assert len(multicasts) == 2  # 503 一次後重送成功
+    assert multicasts[-1]["to"] == ["U1", "U2"] and multicasts[-1]["messages"][0]["text"] == "已核准"
+    assert [body["to"] for path, body in server.requests if path == "/v2/bot/message/push"] == ["U3"]
+    assert reports == []
+
+
+def test_permanent_failure_is_reported(app, stub):
+    server, reports = stub([400]), []
+    line = dispatcher(app, server, reports)
+    line.submit({"U1": "hello"})
+    assert line.flush(timeout=10)
+
+    assert line.stats["failed"] == 1 and line.stats["retries"] == 0
+    assert len(reports) == 1 and "HTTP 400" in reports[0][1]
+    events = line.telemetry.events_df()
+    assert events[["service", "op", "ok"]].values.tolist() == [["line", "push", False]]
+
+
+def test_queue_full_drop_is_recorded(app, stub):
+    server, reports = stub([]), []
+    line = dispatcher(app, server, reports, workers=0, queue_size=1)  # 沒有工作執行緒，第二則必定放不進佇列
+    line.submit({"U1": "第一則", "U2": "第二則"})
+
+    assert line.stats["dropped"] == 1 and line.queue.qsize() == 1
+    assert len(reports) == 1 and "佇列已滿" in reports[0][1] and "第二則" in reports[0][1]
+    assert line.telemetry.events_df()["op"].tolist() == ["dropped"]
@@ -0,0 +1,90 @@
+"""SQLiteStorage 與 KPIDB 讀寫路徑 (含寫入佇列尚未送出時的讀取)"""
+import sqlite3
+
+import pandas as pd
+
+
+def new_tasks(owner, names):
+    return pd.DataFrame([{"owner_email": owner, "task_name": n, "description": "", "start_date": "2025-03-01",
+                          "end_date": "2025-03-31", "size": "M"} for n in names])
+
+
+def task_row(app, task_id, owner="e1@x.com", status="Draft"):
+    row = dict.fromkeys(app.TABLE_COLUMNS["tasks"], "")
+    row.update(task_id=task_id, owner_email=owner, task_name=task_id, status=status, size="M", points=0, progress_pct=0)
+    return [row[c] for c in app.TABLE_COLUMNS["tasks"]]
+
+
+def test_storage_round_trip(app, tmp_path):
+    store = app.SQLiteStorage(str(tmp_path / "kpi.db"), admin_password="pw")
+    assert store.read_table("system_admin").values.tolist() == [["admin", "pw"]]
+    assert store.append_rows("tasks", [task_row(app, "t1"), task_row(app, "t2"), task_row(app, "t3", owner="mgr@x.com")], 0)
+    assert store.update_cells("tasks", {(0, "t1"): {"status": "Submitted", "progress_pct": 40}})
+    assert store.delete_rows("tasks", [(1, "t2")])
+    df = store.read_table("tasks")
+    assert df.task_id.tolist() == ["t1", "t3"]
+    assert df.loc[0, "status"] == "Submitted" and df.loc[0, "progress_pct"] == 40
+
+    assert store.select("tasks", {"owner_email": "e1@x.com", "status": "Submitted"}).task_id.tolist() == ["t1"]
+    assert store.select("tasks", {"owner_email": ["e1@x.com", "mgr@x.com"]}).task_id.tolist() == ["t1", "t3"]
+    assert store.select("tasks", {"owner_email": []}).empty
+
+    store.replace_table("departments", pd.DataFrame([{"dept_id": "D1", "dept_name": "研發"}]))
+    assert store.read_table("departments").values.tolist() == [["D1", "研發", "", ""]]
+
+
+def test_data_version_tracks_other_connections(app, tmp_path):
+    path = str(tmp_path / "kpi.db")
+    store = app.SQLiteStorage(path)
+    before = store.data_version()
+    with sqlite3.connect(path) as other: other.execute('INSERT INTO "system_settings" VALUES (?, ?)', ("logo", ""))
+    assert store.data_version() != before
+
+
+def test_queued_writes_are_visible_to_filtered_reads(db):
+    # 寫入還在佇列時，依條件查詢也要看得到 (由快照過濾，而非直接查 SQLite)
+    db.writer.flush_delay = 0.5
+    result = db.batch_add_tasks(new_tasks("e1@x.com", ["a", "b"]), initial_status="Submitted")
+    ok, msg = result
+    assert ok, msg
+    assert db.cache.pinned("tasks")
+    assert len(db.get_df("tasks", owner_email="e1@x.com")) == 2
+    assert len(db.get_df("tasks", owner_email=["e1@x.com"], status="Submitted")) == 2
+
+    assert result.ticket.result(timeout=5) == (True, "已儲存")
+    db.writer.flush()
+    assert not db.cache.pinned("tasks")
+    assert len(db.get_df("tasks", owner_email="e1@x.com", status="Submitted")) == 2
+    assert len(db.store.read_table("tasks")) == 2
+
+
+def test_update_and_delete_reach_storage(db):
+    db.batch_add_tasks(new_tasks("e1@x.com", ["a", "b", "c"]))
+    ids = db.get_df("tasks").task_id.tolist()
+    assert db.update_progress(ids[1], 60, "half")[0]
+    assert db.batch_update_tasks_status([{"task_id": ids[0], "status": "Approved", "points": 5}])[0]
+    assert db.delete_batch_tasks_by_ids([ids[2]])[0]
+    db.writer.flush()
+
+    stored = db.store.read_table("tasks").set_index("task_id")
+    assert stored.index.tolist() == ids[:2]
+    assert stored.loc[ids[1], "progress_pct"] == 60 and stored.loc[ids[1], "progress_desc"] == "half"
+    assert stored.loc[ids[0], "status"] == "Approved" and stored.loc[ids[0], "points"] == 5
+    # 快照與儲存內容一致，重新載入後結果相同
+    snap = db.get_df("tasks")
+    db.cache.invalidate("tasks")
+    assert db.get_df("tasks").astype(str).equals(snap.astype(str))
+    assert db.points_summary(["e1@x.com"])["點數"].sum() == 5
+
+
+def test_passwords_and_settings(db):
+    assert db.verify_user("e1@x.com", "1")["email"] == "e1@x.com"
+    assert db.change_password("e1@x.com", "new")[0]
+    assert db.verify_user("e1@x.com", "1") is None and db.verify_user("e1@x.com", "new")
+    assert db.verify_user("admin", "admin-pw")["role"] == "admin"
+
+    assert db.update_setting("logo", "https://example.com/a.png")[0]
+    assert db.update_setting("logo", "https://example.com/b.png")[0]
+    db.writer.flush()
+    assert db.store.read_table("system_settings").values.tolist() == [["logo", "https://example.com/b.png"]]
+    assert db.get_setting("logo") == "https://example.com/b.png"